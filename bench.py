@@ -0,0 +1,288 @@
+# Benchmark tải giả lập cho các đường nóng của bots.py: on_presence_update, !onduty/!offduty, reconcile_zones.
+# Chạy offline hoàn toàn: member/guild/kênh/activity đều là đối tượng giả, không kết nối Discord.
+# Kết quả in ra dạng JSON để so sánh giữa các phiên bản, ví dụ:
+#     python bench.py --users 500 --events 20000 --output bench_output.txt
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.messages = 0
+        self.chars = 0
+
+    async def send(self, content=None, **kwargs):
+        self.messages += 1
+        self.chars += len(content or "")
+        return self
+
+    async def edit(self, **kwargs):
+        pass
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = {}
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+class FakeMember:
+    def __init__(self, user_id, guild, status, activities):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = f"Officer {user_id}"
+        self.guild = guild
+        self.status = status
+        self.activities = activities
+        self.roles = []
+
+    def copy(self):
+        # Giống Member._copy của discord.py: bản chụp trạng thái cũ, còn đối tượng trong cache bị sửa tại chỗ
+        member = FakeMember(self.id, self.guild, self.status, self.activities)
+        member.name = self.name
+        member.display_name = self.display_name
+        member.roles = self.roles
+        return member
+
+class FakeContext:
+    def __init__(self, author):
+        self.author = author
+        self.guild = author.guild
+        self.channel = FakeChannel(0)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0, "p50_ms": 0, "p99_ms": 0, "max_ms": 0}
+    samples = sorted(samples)
+    pick = lambda q: samples[int(q * (len(samples) - 1))] * 1000
+    return {"count": len(samples), "p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": samples[-1] * 1000}
+
+def pool_stats(bots):
+    # Số liệu của worker pool lấy từ registry metrics của bots.py
+    wait = bots.metrics.histograms.get(("presence_queue_wait_seconds", ()))
+    handle = bots.metrics.histograms.get(("presence_handle_seconds", ()))
+    summary = lambda histogram: {
+        "avg_ms": histogram.total / histogram.count * 1000 if histogram and histogram.count else 0,
+        "p99_ms": histogram.quantile(0.99) * 1000 if histogram else 0,
+        "max_ms": histogram.max * 1000 if histogram else 0,
+    }
+    return {
+        "queue_depth": [queue.qsize() for queue in bots.presence_workers.queues],
+        "processed": handle.count if handle else 0,
+        "blocked": bots.metrics.counters.get(("presence_blocked_total", ()), 0),
+        "dropped": bots.metrics.counters.get(("presence_dropped_duplicates_total", ()), 0),
+        "wait": summary(wait),
+        "handle": summary(handle),
+    }
+
+def write_bytes():
+    # Tổng số byte process đã ghi qua write(); chỉ có trên Linux
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def make_activities(bots):
+    # Các loại activity mà generator chọn ngẫu nhiên: không chơi, chơi GTA ngoài khu vực, ở từng khu vực, activity khác
+    playing = discord.ActivityType.playing
+    kinds = {
+        "idle": [],
+        "game": [discord.Activity(name="FiveM", state="gta5vn.net", details="Đang lái xe", type=playing)],
+        "other": [discord.Activity(name="Visual Studio Code", details="Editing bots.py", type=playing)],
+    }
+    for zone, config in bots.ZONES.items():
+        for pattern in config["patterns"]:
+            kinds[f"zone:{zone}"] = [discord.Activity(name="FiveM", state="gta5vn.net", details=pattern, type=playing)]
+    return kinds
+
+def generate_events(args, kinds):
+    rng = random.Random(args.seed)
+    zone_kinds = [kind for kind in kinds if kind.startswith("zone:")]
+    events = []
+    for _ in range(args.events):
+        user_id = rng.randrange(args.users) + 1
+        roll = rng.random()
+        if roll < args.zone_ratio and zone_kinds:
+            kind = rng.choice(zone_kinds)
+        elif roll < args.zone_ratio + args.game_ratio:
+            kind = "game"
+        elif roll < args.zone_ratio + args.game_ratio + args.other_ratio:
+            kind = "other"
+        else:
+            kind = "idle"
+        status = discord.Status.offline if rng.random() < args.offline_ratio else rng.choice(
+            [discord.Status.online, discord.Status.idle, discord.Status.dnd]
+        )
+        events.append((user_id, status, kind))
+    return events
+
+async def run(args, bots, workdir):
+    kinds = make_activities(bots)
+    events = generate_events(args, kinds)
+    guild = FakeGuild(args.guild_id)
+    channels = {}
+
+    def get_channel(channel_id):
+        return channels.setdefault(channel_id, FakeChannel(channel_id))
+
+    bots.bot.get_guild = lambda guild_id: guild if guild_id == guild.id else None
+    bots.bot.get_channel = get_channel
+
+    for user_id in range(1, args.users + 1):
+        guild.members[user_id] = FakeMember(user_id, guild, discord.Status.online, [])
+        if user_id <= args.users * args.tracked_ratio:
+            bots.user_mapping[str(user_id)] = {"guild_id": str(guild.id)}
+    bots.roster.rebuild()
+
+    handler = bots.presence_workers.handler
+    handler_samples = []
+
+    async def timed_handler(*handler_args):
+        started = time.perf_counter()
+        try:
+            await handler(*handler_args)
+        finally:
+            handler_samples.append(time.perf_counter() - started)
+
+    bots.presence_workers.handler = timed_handler
+    dispatch_samples = []
+    duty_samples = {"onduty": [], "offduty": []}
+    rng = random.Random(args.seed + 1)
+
+    write_start = write_bytes()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for index, (user_id, status, kind) in enumerate(events):
+        after = guild.members[user_id]
+        before = after.copy()
+        after.status = status
+        after.activities = kinds[kind]
+        t0 = time.perf_counter()
+        await bots.on_presence_update(before, after)
+        dispatch_samples.append(time.perf_counter() - t0)
+
+        if args.duty_every and index % args.duty_every == 0:
+            member = guild.members[rng.randrange(args.users) + 1]
+            command = bots.offduty if str(member.id) in bots.online_start_times else bots.onduty
+            t0 = time.perf_counter()
+            await command.callback(FakeContext(member))
+            duty_samples[command.name].append(time.perf_counter() - t0)
+
+        if args.rate:
+            # Giữ đúng tốc độ sự kiện mong muốn thay vì chạy nhanh hết mức
+            delay = started + (index + 1) / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif index % 64 == 0:
+            await asyncio.sleep(0)
+
+    for queue in bots.presence_workers.queues:
+        await queue.join()
+    presence_seconds = time.perf_counter() - started
+
+    reconcile_samples = []
+    for _ in range(args.reconcile_runs):
+        t0 = time.perf_counter()
+        bots.reconcile_zones(full=True)
+        reconcile_samples.append(time.perf_counter() - t0)
+
+    flush_started = time.perf_counter()
+    await bots.flush_storage()
+    await asyncio.get_running_loop().run_in_executor(bots.persist_executor, lambda: None)
+    flush_seconds = time.perf_counter() - flush_started
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    write_end = write_bytes()
+
+    return {
+        "config": vars(args),
+        "storage_mode": bots.STORAGE_MODE,
+        "presence": {
+            "events": len(events),
+            "seconds": presence_seconds,
+            "events_per_sec": len(events) / presence_seconds if presence_seconds else 0,
+            "dispatch": percentiles(dispatch_samples),
+            "handler": percentiles(handler_samples),
+            "pool": pool_stats(bots),
+            "classifier_hits": bots.activity_classifier.hits,
+            "classifier_misses": bots.activity_classifier.misses,
+        },
+        "duty": {name: percentiles(samples) for name, samples in duty_samples.items()},
+        "reconcile_full": percentiles(reconcile_samples),
+        "notifications": {
+            "queued": bots.notifier.queue_depth(),
+            "messages_sent": sum(channel.messages for channel in channels.values()),
+        },
+        "io": {
+            "final_flush_seconds": flush_seconds,
+            "bytes_written": write_end - write_start if write_start is not None and write_end is not None else None,
+            "disk_bytes": disk_usage(workdir),
+        },
+        "memory": {
+            "peak_traced_bytes": peak_traced,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tải giả lập cho bots.py (không cần kết nối Discord)")
+    parser.add_argument("--users", type=int, default=500, help="số người chơi giả")
+    parser.add_argument("--events", type=int, default=20000, help="số presence update được phát")
+    parser.add_argument("--rate", type=float, default=0, help="số sự kiện mỗi giây, 0 = nhanh nhất có thể")
+    parser.add_argument("--tracked-ratio", type=float, default=1.0, help="tỉ lệ người đã có trong user_mapping lúc bắt đầu")
+    parser.add_argument("--game-ratio", type=float, default=0.4, help="tỉ lệ sự kiện đang chơi GTA ngoài khu vực")
+    parser.add_argument("--zone-ratio", type=float, default=0.2, help="tỉ lệ sự kiện đang ở trong một khu vực")
+    parser.add_argument("--other-ratio", type=float, default=0.2, help="tỉ lệ sự kiện có activity không phải GTA")
+    parser.add_argument("--offline-ratio", type=float, default=0.05, help="tỉ lệ sự kiện có status offline")
+    parser.add_argument("--duty-every", type=int, default=50, help="cứ mỗi N sự kiện thì chạy một lệnh !onduty/!offduty, 0 = tắt")
+    parser.add_argument("--reconcile-runs", type=int, default=5, help="số lần chạy reconcile_zones(full=True) sau cùng")
+    parser.add_argument("--guild-id", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="ghi JSON vào file thay vì stdout")
+    args = parser.parse_args()
+
+    # bots.py đọc/ghi dữ liệu ở thư mục hiện tại nên chạy trong thư mục tạm để không đụng dữ liệu thật
+    sys.path.insert(0, BOT_DIR)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="botofa-bench-")
+    os.chdir(workdir)
+    import bots
+
+    result = asyncio.run(run(args, bots, workdir))
+    bots.flush_storage_sync()
+    text = json.dumps(result, indent=2, default=str)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,28 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 from datetime import datetime, timedelta, date
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from bisect import bisect_left, insort
+from typing import Optional
+import asyncio
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import io
 import json
 import os
+import pstats
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
 import pytz
 
 intents = discord.Intents.default()
@@ -10,7 +30,20 @@ intents.presences = True
 intents.members = True
 intents.message_content = True
 intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# "tracked": không chunk lúc khởi động, cache chỉ giữ người trong user_mapping và người đang chơi game (tải dần khi cần);
+# "all": chunk và cache toàn bộ member của mọi guild như cũ
+MEMBER_CACHE_POLICY = "tracked"
+if MEMBER_CACHE_POLICY == "all":
+    bot = commands.Bot(command_prefix="!", intents=intents)
+else:
+    # Presence của người chưa có trong cache bị discord.py bỏ qua, chỉ còn đến được on_raw_presence_update
+    bot = commands.Bot(
+        command_prefix="!",
+        intents=intents,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False,
+        enable_raw_presences=True,
+    )
 
 bot.remove_command("help")
 
@@ -21,53 +54,1362 @@ REPORT_CHANNEL_ID = 1354521068026593371
 
 ADMIN_ROLE_IDS = ["1346726279696613397", "1346726165976580178"]
 
+# Các khu vực theo dõi: tên khu vực -> chuỗi cần có trong activity và kênh nhận thông báo
+ZONES = {
+    "Vinewood Park Dr": {"patterns": ["Vinewood Park Dr"], "channel_id": NOTIFICATION_CHANNEL_ID},
+}
+ZONE_RECONCILE_MINUTES = 15
+
+GAME_KEYWORDS = ["gta5vn.net", "gta5vn", "gta v", "gta 5", "fivem"]
+ACTIVITY_CACHE_SIZE = 4096
+
+# Thông báo gửi vào cùng một kênh trong khoảng này được gộp thành một tin nhắn
+NOTIFY_BATCH_SECONDS = 2
+MESSAGE_LIMIT = 2000
+# Báo cáo dài hơn một tin nhắn được chia trang, nút lật trang hết hiệu lực sau khoảng thời gian này
+PAGINATOR_TIMEOUT_SECONDS = 300
+# Số báo cáo đã render được giữ lại cho các lệnh admin (!checkreg, !checkduty, !checkdays...)
+REPORT_CACHE_SIZE = 256
+
+# Presence update được chia theo user_id vào các worker cố định: cùng một người luôn xử lý theo thứ tự,
+# người khác nhau chạy song song
+PRESENCE_WORKERS = 8
+PRESENCE_QUEUE_SIZE = 1000
+
 DATA_FILE = "playtime.json"
 ACTIVITY_FILE = "activity.json"
 USER_MAPPING_FILE = "user_mapping.json"
+SQLITE_FILE = "botofa.db"
+SESSION_JOURNAL_FILE = "sessions.log"
+# Mốc chạy gần nhất của các job theo lịch, dùng để bù báo cáo/dọn dữ liệu bị lỡ khi bot tắt
+SCHEDULE_FILE = "schedule.json"
+
+# "json": ghi đè toàn bộ file mỗi lần lưu; "journal": chỉ nối thêm bản ghi thay đổi vào file .log;
+# "sqlite": lưu vào SQLITE_FILE, lần chạy đầu tự chuyển dữ liệu từ các file JSON sang
+STORAGE_MODE = "journal"
+JOURNAL_COMPACT_MINUTES = 10
+# Dữ liệu thay đổi được gom lại và ghi xuống đĩa sau mỗi khoảng này hoặc khi đủ số key chờ ghi
+FLUSH_INTERVAL_SECONDS = 5
+FLUSH_PENDING_THRESHOLD = 100
+RETENTION_DAYS = 14
+# Số ngày giữ lại cho từng loại dữ liệu; "weekly" tính theo ngày Thứ 2 đầu tuần
+RETENTION_WINDOWS = {"playtime": RETENTION_DAYS, "online": RETENTION_DAYS, "weekly": RETENTION_DAYS, "zone": RETENTION_DAYS}
+# Dữ liệu hết hạn được dọn dần mỗi RETENTION_INTERVAL_MINUTES, mỗi đợt tối đa RETENTION_BATCH_SIZE người rồi nhường event loop
+RETENTION_INTERVAL_MINUTES = 10
+RETENTION_BATCH_SIZE = 200
+# Ô ngày hết hạn được gộp vào file nén theo tháng trong thư mục này; chỉ giữ tối đa ARCHIVE_CACHE_MONTHS tháng đã đọc trong bộ nhớ
+ARCHIVE_DIR = "archive"
+ARCHIVE_CACHE_MONTHS = 12
+# Ghi lại presence/lệnh vào file để replay.py phát lại; None = tắt. File được xoay vòng khi vượt EVENT_LOG_MAX_BYTES,
+# giữ EVENT_LOG_BACKUPS file cũ (.1 là mới nhất). EVENT_LOG_HASH_IDS thay ID/tên bằng mã băm có muối EVENT_LOG_SALT
+EVENT_LOG_FILE = None
+EVENT_LOG_MAX_BYTES = 10 * 1024 * 1024
+EVENT_LOG_BACKUPS = 3
+EVENT_LOG_HASH_IDS = True
+EVENT_LOG_SALT = "botofa"
+# Cổng HTTP nội bộ (127.0.0.1) trả số liệu dạng Prometheus tại /metrics; None = tắt
+METRICS_PORT = None
+# !profile và !memtrace: thời gian đo mặc định/tối đa (giây), số dòng trong file kết quả,
+# chu kỳ lấy mẫu stack của chế độ sample và số frame tracemalloc giữ cho mỗi lần cấp phát
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40
+PROFILE_SAMPLE_INTERVAL = 0.005
+MEMTRACE_FRAMES = 10
+DAY_SECONDS = 86400
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def vn_now():
+    # Mọi chỗ lấy giờ hiện tại đều qua hàm này để replay.py có thể thay bằng đồng hồ ảo
+    return datetime.now(VN_TIMEZONE)
+
+def day_number(d):
+    return d.toordinal()
+
+def week_number(d):
+    # date.fromordinal(1) là Thứ 2 nên mỗi tuần Thứ 2 - Chủ Nhật có cùng số tuần
+    return (d.toordinal() - 1) // 7
+
+def week_start_from_number(week):
+    return date.fromordinal(week * 7 + 1)
+
+class DayRing:
+    # Mảng vòng kích thước cố định đánh số theo ngày/tuần, ô cũ tự bị ghi đè nên không cần lọc lại dict
+    __slots__ = ("head", "values")
+
+    def __init__(self, size):
+        self.head = None
+        self.values = array("d", bytes(8 * size))
+
+    def add(self, index, minutes):
+        size = len(self.values)
+        if self.head is None:
+            self.head = index
+        elif index > self.head:
+            for i in range(self.head + 1, min(index, self.head + size) + 1):
+                self.values[i % size] = 0.0
+            self.head = index
+        elif index <= self.head - size:
+            return
+        self.values[index % size] += minutes
+
+    def get(self, index):
+        if self.head is None or index > self.head or index <= self.head - len(self.values):
+            return 0
+        return self.values[index % len(self.values)]
+
+    def items(self):
+        if self.head is None:
+            return
+        size = len(self.values)
+        for index in range(self.head - size + 1, self.head + 1):
+            minutes = self.values[index % size]
+            if minutes:
+                yield index, minutes
+
+    def sum_range(self, start, end):
+        return sum(minutes for index, minutes in self.items() if start <= index <= end)
+
+    def oldest(self):
+        return next((index for index, _ in self.items()), None)
+
+    def expire(self, oldest):
+        # Xóa các ô cũ hơn oldest, trả về các ô (index, phút) vừa bị xóa
+        if self.head is None:
+            return []
+        size = len(self.values)
+        expired = []
+        for index in range(self.head - size + 1, min(oldest, self.head + 1)):
+            minutes = self.values[index % size]
+            if minutes:
+                expired.append((index, minutes))
+                self.values[index % size] = 0.0
+        return expired
+
+class PrefixDayRing(DayRing):
+    # DayRing kèm tổng cộng dồn theo ngày: tổng một khoảng ngày chỉ cần hai lần tra và một phép trừ
+    __slots__ = ("cumulative",)
+
+    def __init__(self, size):
+        DayRing.__init__(self, size)
+        self.cumulative = array("d", bytes(8 * size))
+
+    def add(self, index, minutes):
+        size = len(self.values)
+        if self.head is None:
+            self.head = index
+        elif index > self.head:
+            carry = self.cumulative[self.head % size]
+            for i in range(self.head + 1, min(index, self.head + size) + 1):
+                self.values[i % size] = 0.0
+                self.cumulative[i % size] = carry
+            self.head = index
+        elif index <= self.head - size:
+            return
+        self.values[index % size] += minutes
+        # Thường chỉ ghi vào ngày hiện tại nên vòng này chỉ chạy một lần
+        for i in range(index, self.head + 1):
+            self.cumulative[i % size] += minutes
+
+    def sum_range(self, start, end):
+        if self.head is None:
+            return 0
+        size = len(self.values)
+        start = max(start, self.head - size + 1)
+        end = min(end, self.head)
+        if start > end:
+            return 0
+        return self.cumulative[end % size] - self.cumulative[start % size] + self.values[start % size]
+
+    def expire(self, oldest):
+        expired = DayRing.expire(self, oldest)
+        if self.head is None:
+            return expired
+        size = len(self.values)
+        total = 0.0
+        for index in range(self.head - size + 1, self.head + 1):
+            total += self.values[index % size]
+            self.cumulative[index % size] = total
+        return expired
+
+class UserRecord:
+    # Dữ liệu thời gian của một người; serialize ra đúng định dạng cũ của playtime.json
+    __slots__ = ("user_id", "daily_playtime", "daily_online", "weekly_online", "zone_daily", "last_reset")
+
+    def __init__(self, user_id, last_reset):
+        self.user_id = int(user_id)
+        self.daily_playtime = DayRing(RETENTION_WINDOWS["playtime"] + 1)
+        self.daily_online = PrefixDayRing(RETENTION_WINDOWS["online"] + 1)
+        self.weekly_online = DayRing(RETENTION_WINDOWS["weekly"] // 7 + 1)
+        self.zone_daily = None
+        self.last_reset = last_reset
+
+    def zone_ring(self, zone):
+        # Phần lớn người chơi không vào khu vực nào nên chỉ tạo khi cần
+        if self.zone_daily is None:
+            self.zone_daily = {}
+        if zone not in self.zone_daily:
+            self.zone_daily[zone] = DayRing(RETENTION_WINDOWS["zone"] + 1)
+        return self.zone_daily[zone]
+
+    @classmethod
+    def from_dict(cls, user_id, info):
+        record = cls(user_id, info.get("last_reset"))
+        for field in ("daily_playtime", "daily_online"):
+            for day, minutes in sorted(info.get(field, {}).items()):
+                getattr(record, field).add(day_number(date.fromisoformat(day)), minutes)
+        for week, minutes in sorted(info.get("weekly_online", {}).items()):
+            record.weekly_online.add(week_number(date.fromisoformat(week)), minutes)
+        for zone, days in info.get("zone_daily", {}).items():
+            for day, minutes in sorted(days.items()):
+                record.zone_ring(zone).add(day_number(date.fromisoformat(day)), minutes)
+        return record
+
+    def to_dict(self):
+        data = {
+            "daily_playtime": {date.fromordinal(day).isoformat(): minutes for day, minutes in self.daily_playtime.items()},
+            "daily_online": {date.fromordinal(day).isoformat(): minutes for day, minutes in self.daily_online.items()},
+            "weekly_online": {week_start_from_number(week).isoformat(): minutes for week, minutes in self.weekly_online.items()},
+            "last_reset": self.last_reset
+        }
+        if self.zone_daily:
+            data["zone_daily"] = {
+                zone: {date.fromordinal(day).isoformat(): minutes for day, minutes in ring.items()}
+                for zone, ring in self.zone_daily.items()
+            }
+        return data
+
+    def expire(self, current_date):
+        # Trả về các ô ngày bị xóa dưới dạng (kind, ngày, phút) để đưa vào archive; kind giống account_intervals
+        today = day_number(current_date)
+        expired = [("playtime", day, minutes) for day, minutes in self.daily_playtime.expire(today - RETENTION_WINDOWS["playtime"])]
+        expired += [("online", day, minutes) for day, minutes in self.daily_online.expire(today - RETENTION_WINDOWS["online"])]
+        if self.zone_daily:
+            for zone, ring in list(self.zone_daily.items()):
+                expired += [(f"zone:{zone}", day, minutes) for day, minutes in ring.expire(today - RETENTION_WINDOWS["zone"])]
+                if ring.oldest() is None:
+                    del self.zone_daily[zone]
+        # Giữ các tuần có ngày Thứ 2 không cũ hơn mốc giữ lại, giống cách lọc cũ theo chuỗi ngày.
+        # Tổng tuần không cần lưu trữ vì tính lại được từ các ngày
+        self.weekly_online.expire((today - RETENTION_WINDOWS["weekly"] + 5) // 7)
+        return expired
+
+    def expires_on(self):
+        # Ngày sớm nhất mà record có ô dữ liệu hết hạn, None nếu record không còn dữ liệu
+        days = []
+        rings = [(self.daily_playtime, "playtime"), (self.daily_online, "online")]
+        rings += [(ring, "zone") for ring in (self.zone_daily or {}).values()]
+        for ring, kind in rings:
+            oldest = ring.oldest()
+            if oldest is not None:
+                days.append(oldest + RETENTION_WINDOWS[kind] + 1)
+        oldest_week = self.weekly_online.oldest()
+        if oldest_week is not None:
+            days.append(oldest_week * 7 + 2 + RETENTION_WINDOWS["weekly"])
+        return min(days) if days else None
+
+def json_default(value):
+    if isinstance(value, UserRecord):
+        return value.to_dict()
+    raise TypeError(f"Không thể chuyển {type(value).__name__} sang JSON")
+
+def records_from_dicts(data):
+    return {user_id: UserRecord.from_dict(user_id, info) for user_id, info in data.items()}
+
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # Ước lượng theo cận trên của bucket chứa phân vị q
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(METRIC_BUCKETS[index], self.max) if index < len(METRIC_BUCKETS) else self.max
+        return 0.0
+
+class Metrics:
+    # Counter và histogram trong bộ nhớ; mỗi lần ghi chỉ là một phép tra dict và cộng nên có thể bật thường trực.
+    # labels là tuple các cặp (tên, giá trị) được tạo sẵn ở nơi gọi để không tốn chi phí dựng lại
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.counter_funcs = {}
+        self.started = time.time()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def counter(self, name, func):
+        # Giá trị chỉ tăng do nơi khác tự đếm (vd. hit/miss của cache), xuất ra dạng counter để dùng được rate()
+        self.counter_funcs[name] = func
+
+    def snapshot(self):
+        # persist thread có thể thêm key mới vào counters/histograms trong lúc event loop đang duyệt,
+        # nên chụp lại bằng list() (một lệnh C, không bị thread khác chen giữa) rồi mới sắp xếp/duyệt
+        counters = list(self.counters.items())
+        counters += [((name, ()), func()) for name, func in list(self.counter_funcs.items())]
+        return sorted(counters), sorted(list(self.histograms.items()), key=lambda item: item[0])
+
+    def render_prometheus(self):
+        lines = []
+        counters, histograms = self.snapshot()
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE botofa_{name} counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f"botofa_{name}{format_labels(labels)} {value}")
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# TYPE botofa_{name} histogram")
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"botofa_{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"botofa_{name}_sum{format_labels(labels)} {histogram.total}")
+                lines.append(f"botofa_{name}_count{format_labels(labels)} {histogram.count}")
+        for name, func in sorted(list(self.gauges.items())):
+            lines.append(f"# TYPE botofa_{name} gauge")
+            lines.append(f"botofa_{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+
+def measured(metric, label):
+    # Đo thời gian chạy của handler async/hàm thường theo metric{label=tên hàm}, đếm luôn số lần lỗi
+    def decorate(func):
+        labels = ((label, func.__name__),)
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    metrics.inc(f"{metric}_errors_total", labels)
+                    raise
+                finally:
+                    metrics.observe(f"{metric}_seconds", time.perf_counter() - started, labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    metrics.observe(f"{metric}_seconds", time.perf_counter() - started, labels)
+        return wrapper
+    return decorate
+
+class WriteBehindStore:
+    # Ghi nhớ các key bị thay đổi, việc ghi thật sự do flush_storage thực hiện trên persist_executor
+    incremental = True
+
+    def __init__(self):
+        self.records = 0
+        self.data = None
+        self.dirty_keys = set()
+        self.full_dirty = False
+
+    def mark(self, data, keys):
+        self.data = data
+        if keys and self.incremental:
+            self.dirty_keys.update(keys)
+        else:
+            self.full_dirty = True
+
+    def pending_count(self):
+        return len(self.dirty_keys) + (FLUSH_PENDING_THRESHOLD if self.full_dirty else 0)
+
+    def take_pending(self, hold=()):
+        # Chạy trên event loop: chụp lại dữ liệu cần ghi để thread ghi không đụng vào dict đang dùng.
+        # Các key trong hold vẫn được giữ dirty cho lần sau; bản ghi toàn bộ thì đợi tới khi không còn key nào bị giữ
+        if self.full_dirty:
+            if hold:
+                return None
+            job = ("snapshot", self.encode_all(self.data))
+            self.full_dirty = False
+            self.dirty_keys = set()
+            return job
+        keys = self.dirty_keys - hold if hold else self.dirty_keys
+        if not keys:
+            return None
+        self.dirty_keys = self.dirty_keys & hold if hold else set()
+        return ("update", self.encode_keys(self.data, keys))
+
+    def write(self, job):
+        if job[0] == "snapshot":
+            self.write_snapshot(job[1])
+        else:
+            self.write_update(job[1])
+
+    def compact(self, data):
+        self.write_snapshot(self.encode_all(data))
+
+    def compact_from_disk(self):
+        pass
+
+class JsonJournal(WriteBehindStore):
+    # Snapshot JSON + log nối tiếp, mỗi dòng log là giá trị mới nhất của một key
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.log_path = path + ".log"
+        self.incremental = STORAGE_MODE == "journal"
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        self.records = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Dòng cuối bị ghi dở do bot tắt đột ngột
+                        break
+                    if "v" in record:
+                        data[record["k"]] = record["v"]
+                    else:
+                        data.pop(record["k"], None)
+                    self.records += 1
+        return data
+
+    def encode_all(self, data):
+        return json.dumps(data, indent=4, default=json_default)
+
+    def encode_keys(self, data, keys):
+        lines = []
+        for key in keys:
+            if key in data:
+                record = {"k": key, "v": data[key]}
+            else:
+                record = {"k": key}
+            lines.append(json.dumps(record, separators=(",", ":"), default=json_default) + "\n")
+        return "".join(lines), len(lines)
+
+    def write_update(self, payload):
+        text, count = payload
+        with open(self.log_path, "a") as f:
+            f.write(text)
+        self.records += count
+
+    def write_snapshot(self, text):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+        if self.records or os.path.exists(self.log_path):
+            open(self.log_path, "w").close()
+        self.records = 0
+
+    def compact_from_disk(self):
+        # Gộp snapshot + log ngay trên đĩa, không cần chạm vào dữ liệu trong bộ nhớ
+        self.compact(self.load())
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS activity (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS playtime_meta (user_id INTEGER PRIMARY KEY, last_reset TEXT);
+CREATE TABLE IF NOT EXISTS daily_playtime (
+    user_id INTEGER NOT NULL, day INTEGER NOT NULL, minutes REAL NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_online (
+    user_id INTEGER NOT NULL, day INTEGER NOT NULL, minutes REAL NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS weekly_online (
+    user_id INTEGER NOT NULL, week INTEGER NOT NULL, minutes REAL NOT NULL,
+    PRIMARY KEY (user_id, week)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zone_daily (
+    user_id INTEGER NOT NULL, zone TEXT NOT NULL, day INTEGER NOT NULL, minutes REAL NOT NULL,
+    PRIMARY KEY (user_id, zone, day)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_playtime_day ON daily_playtime (day, user_id);
+CREATE INDEX IF NOT EXISTS daily_online_day ON daily_online (day, user_id);
+CREATE INDEX IF NOT EXISTS weekly_online_week ON weekly_online (week, user_id);
+"""
+
+class SqliteStore(WriteBehindStore):
+    # Cùng giao diện với JsonJournal; các lớp con quy định bảng và cách chuyển dict <-> dòng
+    tables = ()
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.path = f"{SQLITE_FILE}:{self.tables[0]}"
+
+    def encode_all(self, data):
+        return [self.encode(user_id, value) for user_id, value in data.items()]
+
+    def encode_keys(self, data, keys):
+        return [(int(key), self.encode(key, data[key]) if key in data else None) for key in keys]
+
+    def write_update(self, payload):
+        with self.db:
+            for user_id, rows in payload:
+                for table in self.tables:
+                    self.db.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+                if rows is not None:
+                    self.insert(rows)
+
+    def write_snapshot(self, payload):
+        with self.db:
+            for table in self.tables:
+                self.db.execute(f"DELETE FROM {table}")
+            for rows in payload:
+                self.insert(rows)
+
+class SqlitePlaytimeStore(SqliteStore):
+    tables = ("playtime_meta", "daily_playtime", "daily_online", "weekly_online", "zone_daily")
+
+    def load(self):
+        data = {}
+        for user_id, last_reset in self.db.execute("SELECT user_id, last_reset FROM playtime_meta"):
+            data[str(user_id)] = UserRecord(user_id, last_reset)
+        for table in ("daily_playtime", "daily_online", "weekly_online"):
+            for user_id, index, minutes in self.db.execute(f"SELECT * FROM {table} ORDER BY 2"):
+                getattr(data[str(user_id)], table).add(index, minutes)
+        for user_id, zone, day, minutes in self.db.execute("SELECT * FROM zone_daily ORDER BY 3"):
+            data[str(user_id)].zone_ring(zone).add(day, minutes)
+        return data
+
+    def encode(self, user_id, record):
+        user_id = int(user_id)
+        rows = {"playtime_meta": [(user_id, record.last_reset)]}
+        for table in ("daily_playtime", "daily_online", "weekly_online"):
+            rows[table] = [(user_id, index, minutes) for index, minutes in getattr(record, table).items()]
+        rows["zone_daily"] = [
+            (user_id, zone, day, minutes)
+            for zone, ring in (record.zone_daily or {}).items()
+            for day, minutes in ring.items()
+        ]
+        return rows
+
+    def insert(self, rows):
+        self.db.executemany("INSERT INTO playtime_meta VALUES (?, ?)", rows["playtime_meta"])
+        for table in ("daily_playtime", "daily_online", "weekly_online"):
+            self.db.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)", rows[table])
+        self.db.executemany("INSERT INTO zone_daily VALUES (?, ?, ?, ?)", rows["zone_daily"])
+
+class SqliteActivityStore(SqliteStore):
+    tables = ("activity",)
+
+    def load(self):
+        return {str(user_id): json.loads(text) for user_id, text in self.db.execute("SELECT user_id, data FROM activity")}
+
+    def encode(self, user_id, info):
+        return (int(user_id), json.dumps(info))
+
+    def insert(self, rows):
+        self.db.execute("INSERT INTO activity VALUES (?, ?)", rows)
+
+class SqliteUserMappingStore(SqliteStore):
+    tables = ("users",)
+
+    def load(self):
+        return {str(user_id): {"guild_id": str(guild_id)} for user_id, guild_id in self.db.execute("SELECT user_id, guild_id FROM users")}
+
+    def encode(self, user_id, info):
+        return (int(user_id), int(info["guild_id"]))
+
+    def insert(self, rows):
+        self.db.execute("INSERT INTO users VALUES (?, ?)", rows)
+
+def open_sqlite_db():
+    db = sqlite3.connect(SQLITE_FILE, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SQLITE_SCHEMA)
+    return db
+
+def migrate_json_to_sqlite():
+    # Chuyển một lần dữ liệu từ playtime.json, activity.json, user_mapping.json (kể cả log) sang SQLite
+    if sqlite_db.execute("PRAGMA user_version").fetchone()[0] >= 1:
+        return
+    for store, path in (
+        (playtime_store, DATA_FILE),
+        (activity_store, ACTIVITY_FILE),
+        (user_mapping_store, USER_MAPPING_FILE),
+    ):
+        data = JsonJournal(path).load()
+        if store is playtime_store:
+            data = records_from_dicts(data)
+        if store is user_mapping_store:
+            data = {k: v for k, v in data.items() if isinstance(v, dict) and "guild_id" in v}
+        store.compact(data)
+        if data:
+            print(f"Đã chuyển {len(data)} bản ghi từ {path} sang {SQLITE_FILE}")
+    sqlite_db.execute("PRAGMA user_version = 1")
+    sqlite_db.commit()
+
+if STORAGE_MODE == "sqlite":
+    sqlite_db = open_sqlite_db()
+    playtime_store = SqlitePlaytimeStore(sqlite_db)
+    activity_store = SqliteActivityStore(sqlite_db)
+    user_mapping_store = SqliteUserMappingStore(sqlite_db)
+    migrate_json_to_sqlite()
+else:
+    playtime_store = JsonJournal(DATA_FILE)
+    activity_store = JsonJournal(ACTIVITY_FILE)
+    user_mapping_store = JsonJournal(USER_MAPPING_FILE)
+stores = [playtime_store, activity_store, user_mapping_store]
+
+# Một thread duy nhất để các lần ghi luôn theo đúng thứ tự
+persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+flush_scheduled = False
+
+def write_jobs(jobs):
+    for store, job in jobs:
+        started = time.perf_counter()
+        try:
+            store.write(job)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Lỗi khi ghi {store.path}: {e}")
+            metrics.inc("storage_write_errors_total", (("store", store.path),))
+            store.full_dirty = True
+        metrics.observe("storage_write_seconds", time.perf_counter() - started, (("store", store.path),))
+
+def take_jobs():
+    # Record có ô hết hạn chưa ghi được vào archive thì chưa được lưu bản đã cắt xuống đĩa
+    held = archive.held_users()
+    jobs = []
+    for store in stores:
+        job = store.take_pending(held if store is playtime_store else ())
+        if job:
+            jobs.append((store, job))
+    return jobs
+
+async def flush_storage():
+    global flush_scheduled
+    flush_scheduled = False
+    jobs = take_jobs()
+    if jobs:
+        await asyncio.get_running_loop().run_in_executor(persist_executor, write_jobs, jobs)
+
+def flush_storage_sync():
+    persist_executor.shutdown(wait=True)
+    archive.flush_sync()
+    write_jobs(take_jobs())
+
+def save_to_store(store, data, keys):
+    # Không truyền key nào thì ghi lại toàn bộ (dùng khi thay đổi hàng loạt)
+    global flush_scheduled
+    store.mark(data, keys)
+    if not flush_scheduled and store.pending_count() >= FLUSH_PENDING_THRESHOLD:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        flush_scheduled = True
+        loop.create_task(flush_storage())
 
 def load_playtime_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {}
+    data = playtime_store.load()
+    if STORAGE_MODE == "sqlite":
+        return data
+    return records_from_dicts(data)
 
-def save_playtime_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+@measured("save", "function")
+def save_playtime_data(data, *user_ids):
+    save_to_store(playtime_store, data, user_ids)
 
 def load_activity_data():
-    if os.path.exists(ACTIVITY_FILE):
-        with open(ACTIVITY_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_activity_data(data):
-    with open(ACTIVITY_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    data = activity_store.load()
+    for info in data.values():
+        # Định dạng cũ chỉ có một khu vực Vinewood
+        if "in_vinewood" in info:
+            in_vinewood = info.pop("in_vinewood")
+            start_time_str = info.pop("vinewood_start_time", None)
+            if in_vinewood and start_time_str and "Vinewood Park Dr" in ZONES:
+                info.setdefault("zones", {})["Vinewood Park Dr"] = start_time_str
+    return data
+
+@measured("save", "function")
+def save_activity_data(data, *user_ids):
+    save_to_store(activity_store, data, user_ids)
 
 def load_user_mapping():
-    if os.path.exists(USER_MAPPING_FILE):
-        with open(USER_MAPPING_FILE, "r") as f:
-            data = json.load(f)
-            filtered_data = {}
-            for user_id, user_info in data.items():
-                if isinstance(user_info, dict) and "guild_id" in user_info:
-                    filtered_data[user_id] = user_info
-            if data != filtered_data:
-                with open(USER_MAPPING_FILE, "w") as f:
-                    json.dump(filtered_data, f, indent=4)
-            return filtered_data
-    return {}
-
-def save_user_mapping(data):
-    with open(USER_MAPPING_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    data = user_mapping_store.load()
+    filtered_data = {}
+    for user_id, user_info in data.items():
+        if isinstance(user_info, dict) and "guild_id" in user_info:
+            filtered_data[user_id] = user_info
+    if data != filtered_data:
+        user_mapping_store.compact(filtered_data)
+    return filtered_data
+
+@measured("save", "function")
+def save_user_mapping(data, *user_ids):
+    save_to_store(user_mapping_store, data, user_ids)
+
+async def query_online_totals(start_date, end_date):
+    # Tổng số phút on-duty của từng người trong khoảng ngày [start_date, end_date], đọc từ PrefixDayRing trong bộ nhớ;
+    # chỉ khi khoảng ngày lùi quá thời gian giữ lại mới mở thêm các tháng cần thiết trong archive
+    start_day = day_number(start_date)
+    end_day = day_number(end_date)
+    totals = {}
+    for user_id, record in playtime_data.items():
+        total_online = record.daily_online.sum_range(start_day, end_day)
+        if total_online:
+            totals[user_id] = total_online
+    if archived_before(start_day, "online"):
+        for user_id, days in (await archive.days("online", start_day, end_day)).items():
+            totals[user_id] = totals.get(user_id, 0) + sum(days.values())
+    return totals
+
+class SessionJournal:
+    # Log fsync cho các ca đang mở để khởi động lại không làm mất thời gian on-duty/chơi game
+    def __init__(self, path):
+        self.path = path
+        self.open_sessions = {}
+        self.records = 0
+
+    def load(self):
+        self.open_sessions = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    key = (record["s"], record["u"])
+                    if "t" in record:
+                        self.open_sessions[key] = record["t"]
+                    else:
+                        self.open_sessions.pop(key, None)
+        # Ghi lại log chỉ còn các ca đang mở nên lần khởi động sau chỉ phải đọc O(số ca đang mở)
+        self.rewrite(self.encode_open())
+        return {key: datetime.fromisoformat(t).astimezone(VN_TIMEZONE) for key, t in self.open_sessions.items()}
+
+    def encode_open(self):
+        return "".join(
+            json.dumps({"s": kind, "u": user_id, "t": t}, separators=(",", ":")) + "\n"
+            for (kind, user_id), t in self.open_sessions.items()
+        )
+
+    def record(self, kind, user_id, start_time=None):
+        # Chỉ đưa việc ghi sang persist_executor, không chờ nên !onduty không bị chậm thêm
+        if start_time is None:
+            self.open_sessions.pop((kind, user_id), None)
+            entry = {"s": kind, "u": user_id}
+        else:
+            self.open_sessions[(kind, user_id)] = start_time.isoformat()
+            entry = {"s": kind, "u": user_id, "t": start_time.isoformat()}
+        self.records += 1
+        persist_executor.submit(self.append, json.dumps(entry, separators=(",", ":")) + "\n")
+        if self.records > 64 + 4 * len(self.open_sessions):
+            self.records = len(self.open_sessions)
+            persist_executor.submit(self.rewrite, self.encode_open())
+
+    def append(self, line):
+        try:
+            with open(self.path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"Lỗi khi ghi {self.path}: {e}")
+
+    def rewrite(self, text):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Lỗi khi ghi {self.path}: {e}")
+
+session_journal = SessionJournal(SESSION_JOURNAL_FILE)
+
+data_version = 0
+report_cache = {}
+
+def bump_data_version():
+    # Gọi mỗi khi dữ liệu mà các báo cáo đọc bị thay đổi; mọi báo cáo đã cache trước đó tự hết hạn
+    global data_version
+    data_version += 1
+
+async def cached_report(key, render):
+    # key gồm (lệnh, guild, tham số); chỉ render lại khi data_version đã đổi
+    entry = report_cache.get(key)
+    if entry is not None and entry[0] == data_version:
+        return entry[1]
+    version = data_version
+    value = await render()
+    if len(report_cache) >= REPORT_CACHE_SIZE:
+        report_cache.clear()
+    report_cache[key] = (version, value)
+    return value
+
+def begin_session(kind, user_id, start_time):
+    session_maps[kind][user_id] = start_time
+    session_journal.record(kind, user_id, start_time)
+    bump_data_version()
+
+def end_session(kind, user_id):
+    start_time = session_maps[kind].pop(user_id)
+    session_journal.record(kind, user_id)
+    bump_data_version()
+    return start_time
+
+def session_open_at(kind, user_id, current_time):
+    # Sự kiện presence chờ trong hàng đợi worker có thể đến sau một lệnh (vd. !onduty) mở phiên mới;
+    # phiên bắt đầu sau thời điểm của sự kiện thì sự kiện đó không được đóng
+    start_time = session_maps[kind].get(user_id)
+    return start_time is not None and start_time <= current_time
+
+def restore_sessions():
+    for (kind, user_id), start_time in session_journal.load().items():
+        if kind in session_maps:
+            session_maps[kind][user_id] = start_time
+    restored = len(online_start_times)
+    if restored:
+        print(f"Đã khôi phục {restored} ca on-duty đang mở từ {SESSION_JOURNAL_FILE}")
 
 def get_week_boundaries(date):
     start_of_week = date - timedelta(days=date.weekday())
     end_of_week = start_of_week + timedelta(days=6)
     return start_of_week, end_of_week
 
+class WeeklyLeaderboard:
+    # Tổng phút on-duty theo tuần, luôn giữ sẵn thứ tự giảm dần để lấy top N / bảng xếp hạng không phải tính lại
+    def __init__(self):
+        self.weeks = {}
+
+    def add(self, week, user_id, minutes):
+        totals, ranking = self.weeks.setdefault(week, ({}, []))
+        old = totals.get(user_id)
+        if old is not None:
+            del ranking[bisect_left(ranking, (-old, user_id))]
+        total = (old or 0) + minutes
+        totals[user_id] = total
+        insort(ranking, (-total, user_id))
+
+    def remove_user(self, user_id):
+        for totals, ranking in self.weeks.values():
+            old = totals.pop(user_id, None)
+            if old is not None:
+                del ranking[bisect_left(ranking, (-old, user_id))]
+
+    def prune(self, oldest_week):
+        for week in [week for week in self.weeks if week < oldest_week]:
+            del self.weeks[week]
+
+    def ranked(self, week):
+        _, ranking = self.weeks.get(week, ({}, []))
+        for minutes, user_id in list(ranking):
+            yield user_id, -minutes
+
+def build_leaderboard():
+    board = WeeklyLeaderboard()
+    for user_id, record in playtime_data.items():
+        for week, minutes in record.weekly_online.items():
+            board.add(week, user_id, minutes)
+    return board
+
+def get_user_record(user_id, current_time):
+    record = playtime_data.get(user_id)
+    if record is None:
+        record = UserRecord(user_id, current_time.isoformat())
+        playtime_data[user_id] = record
+    return record
+
+class RetentionEngine:
+    # Min-heap (ngày hết hạn, user_id): mỗi lượt chỉ động tới các record đã có ô hết hạn thay vì quét toàn bộ playtime_data.
+    # due giữ ngày đã lên lịch của từng người để bỏ qua các mục cũ còn sót trong heap
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+
+    def schedule(self, user_id, expires_on):
+        if expires_on is None:
+            self.due.pop(user_id, None)
+            return
+        current = self.due.get(user_id)
+        if current is not None and current <= expires_on:
+            return
+        self.due[user_id] = expires_on
+        heapq.heappush(self.heap, (expires_on, user_id))
+
+    def rebuild(self, data):
+        self.due = {}
+        for user_id, record in data.items():
+            # Record rỗng (còn sót từ cách reset cũ) được xóa ngay ở lượt dọn đầu tiên
+            expires_on = record.expires_on()
+            self.due[user_id] = 0 if expires_on is None else expires_on
+        self.heap = [(expires_on, user_id) for user_id, expires_on in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def expire_record(self, user_id, record, current_date, expired):
+        # Cắt các ô hết hạn của một record, thêm chúng vào expired; trả về False nếu record hết dữ liệu và đã bị xóa
+        self.due.pop(user_id, None)
+        expired.extend((user_id, kind, day, minutes) for kind, day, minutes in record.expire(current_date))
+        expires_on = record.expires_on()
+        if expires_on is None:
+            # Không còn dữ liệu trong thời gian giữ lại thì xóa hẳn, thay cho việc reset theo last_reset trước đây.
+            # Bỏ luôn khỏi bảng xếp hạng tuần thay vì đợi prune dọn tuần cũ
+            del playtime_data[user_id]
+            leaderboard.remove_user(user_id)
+            return False
+        self.schedule(user_id, expires_on)
+        return True
+
+    def prepare_write(self, user_id, day):
+        # Gọi trước khi ghi vào ngày day: ô cũ sắp bị mảng vòng ghi đè phải được đưa vào archive trước
+        if self.due.get(user_id, day + 1) > day:
+            return
+        record = playtime_data.get(user_id)
+        if record is None:
+            self.due.pop(user_id, None)
+            return
+        expired = []
+        self.expire_record(user_id, record, date.fromordinal(day), expired)
+        archive.add(expired)
+
+    async def run(self, current_date, batch_size=RETENTION_BATCH_SIZE):
+        today = day_number(current_date)
+        touched = []
+        removed = []
+        expired = []
+        while self.heap and self.heap[0][0] <= today:
+            expires_on, user_id = heapq.heappop(self.heap)
+            if self.due.get(user_id) != expires_on:
+                continue
+            record = playtime_data.get(user_id)
+            if record is None:
+                del self.due[user_id]
+                continue
+            expires_on = record.expires_on()
+            if expires_on is not None and expires_on > today:
+                del self.due[user_id]
+                self.schedule(user_id, expires_on)
+                continue
+            if self.expire_record(user_id, record, current_date, expired):
+                touched.append(user_id)
+            else:
+                removed.append(user_id)
+            if (len(touched) + len(removed)) % batch_size == 0:
+                await asyncio.sleep(0)
+        leaderboard.prune((today - RETENTION_WINDOWS["weekly"] + 5) // 7)
+        # Record đã cắt chỉ được lưu sau khi archive ghi xong (xem take_jobs); flush cũng thử lại các tháng ghi lỗi lần trước
+        archive.add(expired)
+        await archive.flush()
+        if touched or removed:
+            bump_data_version()
+            save_playtime_data(playtime_data, *touched, *removed)
+        return len(touched), len(removed)
+
+def month_key(day):
+    return date.fromordinal(day).strftime("%Y-%m")
+
+def months_between(start_day, end_day):
+    start = date.fromordinal(start_day)
+    end = date.fromordinal(end_day)
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield f"{year:04d}-{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+class MonthlyArchive:
+    # Lưu trữ dài hạn: mỗi tháng một file archive/YYYY-MM.json.gz dạng {user_id: {kind: {ngày ISO: phút}}}.
+    # index.json ghi tháng nào có những user nào, truy vấn chỉ mở đúng các tháng cần và giữ LRU các tháng đã mở
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}
+        self.segments = OrderedDict()
+        # Các ô chưa ghi xuống đĩa, theo tháng; inflight là lô đang được ghi. Ghi lỗi thì giữ lại để thử lại ở lượt dọn sau
+        self.pending = {}
+        self.inflight = {}
+        self.flushing = False
+
+    def path(self, month):
+        return os.path.join(self.directory, f"{month}.json.gz")
+
+    def load_index(self):
+        try:
+            with open(os.path.join(self.directory, "index.json"), "r") as f:
+                self.index = {month: set(user_ids) for month, user_ids in json.load(f).items()}
+        except (OSError, ValueError):
+            self.index = {}
+
+    def read(self, month):
+        try:
+            with gzip.open(self.path(month), "rt") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, month, updates):
+        # Chạy trên persist_executor nên đọc-gộp-ghi theo đúng thứ tự với các lần ghi khác
+        os.makedirs(self.directory, exist_ok=True)
+        segment = self.read(month)
+        merge_archive(segment, updates)
+        tmp_path = self.path(month) + ".tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump(segment, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path(month))
+
+    def write_all(self, batch, index_text):
+        # Trả về các tháng ghi lỗi; index.json lỗi thì coi như cả lô lỗi vì truy vấn dựa vào nó để tìm tháng
+        failed = set()
+        for month, updates in batch.items():
+            try:
+                self.write(month, updates)
+            except OSError as e:
+                print(f"Lỗi khi ghi archive tháng {month}: {e}")
+                failed.add(month)
+        try:
+            index_path = os.path.join(self.directory, "index.json")
+            with open(index_path + ".tmp", "w") as f:
+                f.write(index_text)
+            os.replace(index_path + ".tmp", index_path)
+        except OSError as e:
+            print(f"Lỗi khi ghi {index_path}: {e}")
+            failed = set(batch)
+        if failed:
+            metrics.inc("archive_write_errors_total", value=len(failed))
+        return failed
+
+    def add(self, expired):
+        # expired: list (user_id, kind, ngày, phút); mỗi tháng chỉ ghi một lần cho cả lô
+        if not expired:
+            return
+        updates = {}
+        for user_id, kind, day, minutes in expired:
+            days = updates.setdefault(month_key(day), {}).setdefault(user_id, {}).setdefault(kind, {})
+            days[date.fromordinal(day).isoformat()] = minutes
+        for month, month_updates in updates.items():
+            self.index.setdefault(month, set()).update(month_updates)
+            merge_archive(self.pending.setdefault(month, {}), month_updates)
+            if month in self.segments:
+                merge_archive(self.segments[month], month_updates)
+        try:
+            asyncio.get_running_loop().create_task(self.flush())
+        except RuntimeError:
+            # Không có event loop (vd. lúc tắt bot): flush_storage_sync sẽ ghi
+            pass
+
+    def held_users(self):
+        return {user_id for batch in (self.pending, self.inflight) for updates in batch.values() for user_id in updates}
+
+    def take_batch(self):
+        self.inflight, self.pending = self.pending, {}
+        return self.inflight, json.dumps({month: sorted(user_ids) for month, user_ids in self.index.items()})
+
+    def restore_failed(self, failed):
+        # Ô mới hơn trong pending được ưu tiên hơn ô của lô ghi lỗi
+        for month in failed:
+            merged = self.inflight[month]
+            merge_archive(merged, self.pending.get(month, {}))
+            self.pending[month] = merged
+        self.inflight = {}
+
+    async def flush(self):
+        if self.flushing:
+            return
+        self.flushing = True
+        held = self.held_users()
+        try:
+            while self.pending:
+                batch, index_text = self.take_batch()
+                failed = await asyncio.get_running_loop().run_in_executor(persist_executor, self.write_all, batch, index_text)
+                self.restore_failed(failed)
+                if failed:
+                    break
+        finally:
+            self.flushing = False
+        # Record của những người đã ghi xong archive giờ mới được lưu bản đã cắt
+        released = held - self.held_users()
+        if released:
+            save_playtime_data(playtime_data, *released)
+
+    def flush_sync(self):
+        if self.pending:
+            batch, index_text = self.take_batch()
+            self.restore_failed(self.write_all(batch, index_text))
+
+    async def segment(self, month):
+        if month not in self.index:
+            return {}
+        segment = self.segments.get(month)
+        if segment is None:
+            segment = await asyncio.get_running_loop().run_in_executor(persist_executor, self.read, month)
+            # Ô chưa ghi xuống đĩa vẫn phải thấy được khi truy vấn
+            for batch in (self.inflight, self.pending):
+                merge_archive(segment, batch.get(month, {}))
+            self.segments[month] = segment
+            if len(self.segments) > ARCHIVE_CACHE_MONTHS:
+                self.segments.popitem(last=False)
+        else:
+            self.segments.move_to_end(month)
+        return segment
+
+    async def days(self, kind, start_day, end_day, user_id=None):
+        # Trả về {user_id: {ngày: phút}} trong khoảng [start_day, end_day], chỉ mở các tháng có dữ liệu
+        result = {}
+        start_iso = date.fromordinal(start_day).isoformat()
+        end_iso = date.fromordinal(end_day).isoformat()
+        for month in months_between(start_day, end_day):
+            if user_id is not None and user_id not in self.index.get(month, ()):
+                continue
+            segment = await self.segment(month)
+            users = [user_id] if user_id is not None else list(segment)
+            for uid in users:
+                for day, minutes in segment.get(uid, {}).get(kind, {}).items():
+                    if start_iso <= day <= end_iso:
+                        result.setdefault(uid, {})[day_number(date.fromisoformat(day))] = minutes
+        return result
+
+def merge_archive(segment, updates):
+    # Gán đè theo ngày nên ghi lại cùng một ô (vd bot tắt trước khi record kịp lưu) không bị cộng hai lần
+    for user_id, kinds in updates.items():
+        for kind, days in kinds.items():
+            segment.setdefault(user_id, {}).setdefault(kind, {}).update(days)
+
+archive = MonthlyArchive(ARCHIVE_DIR)
+archive.load_index()
+
+def archived_before(start_day, kind):
+    # Ngày cũ hơn mốc này có thể đã nằm trong archive
+    return start_day < day_number(vn_now().date()) - RETENTION_WINDOWS[kind]
+
+async def user_day_totals(user_id, kind, start_day, end_day):
+    # {ngày: phút} của một người, gộp dữ liệu nóng trong record với archive
+    totals = {}
+    if archived_before(start_day, kind):
+        totals.update((await archive.days(kind, start_day, end_day, user_id)).get(user_id, {}))
+    record = playtime_data.get(user_id)
+    if record is not None:
+        if kind == "online":
+            ring = record.daily_online
+        elif kind == "playtime":
+            ring = record.daily_playtime
+        else:
+            ring = (record.zone_daily or {}).get(kind[len("zone:"):])
+        for day, minutes in (ring.items() if ring else ()):
+            if start_day <= day <= end_day:
+                totals[day] = totals.get(day, 0) + minutes
+    return totals
+
+def split_interval(start, end):
+    # Chia [start, end) theo ranh giới ngày của VN_TIMEZONE, trả về list (số ngày, số phút).
+    # Việt Nam không đổi giờ nên chỉ cần cộng offset một lần rồi tính bằng số giây
+    offset = start.astimezone(VN_TIMEZONE).utcoffset().total_seconds()
+    begin = start.timestamp() + offset
+    finish = end.timestamp() + offset
+    parts = []
+    while begin < finish:
+        day = int(begin // DAY_SECONDS)
+        chunk_end = min((day + 1) * DAY_SECONDS, finish)
+        parts.append((day + EPOCH_ORDINAL, (chunk_end - begin) / 60))
+        begin = chunk_end
+    return parts
+
+def account_intervals(intervals, kind="online", current_time=None):
+    # Cộng dồn một lô (user_id, start, end): gom theo (user, ngày) trước rồi mới ghi vào record.
+    # kind "online" cộng vào daily_online + weekly_online, "playtime" cộng vào daily_playtime,
+    # "zone:<tên khu vực>" cộng vào thời gian ở trong khu vực đó
+    current_time = current_time or vn_now()
+    totals = defaultdict(float)
+    for user_id, start, end in intervals:
+        for day, minutes in split_interval(start, end):
+            totals[user_id, day] += minutes
+    touched = set()
+    for (user_id, day), minutes in totals.items():
+        retention.prepare_write(user_id, day)
+        record = get_user_record(user_id, current_time)
+        if kind == "online":
+            record.daily_online.add(day, minutes)
+            record.weekly_online.add((day - 1) // 7, minutes)
+            leaderboard.add((day - 1) // 7, user_id, minutes)
+            expires_on = min(day + RETENTION_WINDOWS["online"], (day - 1) // 7 * 7 + 1 + RETENTION_WINDOWS["weekly"]) + 1
+        elif kind == "playtime":
+            record.daily_playtime.add(day, minutes)
+            expires_on = day + RETENTION_WINDOWS["playtime"] + 1
+        else:
+            record.zone_ring(kind[len("zone:"):]).add(day, minutes)
+            expires_on = day + RETENTION_WINDOWS["zone"] + 1
+        retention.schedule(user_id, expires_on)
+        touched.add(user_id)
+    if touched:
+        bump_data_version()
+        save_playtime_data(playtime_data, *touched)
+    return touched
+
+def account_interval(user_id, start, end, kind="online"):
+    return account_intervals([(user_id, start, end)], kind, end)
+
+class RosterIndex:
+    # Người trong user_mapping nhóm theo guild (khóa số nguyên) kèm tên hiển thị đã lấy sẵn.
+    # Được giữ đúng bởi on_member_update/on_member_remove/on_guild_remove nên các báo cáo không phải tra từng người
+    def __init__(self):
+        self.guilds = {}
+        self.user_guilds = {}
+
+    def rebuild(self):
+        # Trả về các user có guild không còn tồn tại
+        self.guilds = {}
+        self.user_guilds = {}
+        stale = []
+        for user_id, user_info in user_mapping.items():
+            guild = bot.get_guild(int(user_info["guild_id"]))
+            if not guild:
+                stale.append(user_id)
+                continue
+            self.user_guilds[int(user_id)] = guild.id
+            member = member_loader.get(guild, int(user_id))
+            if member:
+                self.guilds.setdefault(guild.id, {})[member.id] = member.display_name
+        bump_data_version()
+        return stale
+
+    def add(self, guild_id, user_id, display_name):
+        self.user_guilds[user_id] = guild_id
+        self.guilds.setdefault(guild_id, {})[user_id] = display_name
+        bump_data_version()
+
+    def update(self, member):
+        members = self.guilds.get(member.guild.id)
+        if members is not None and member.id in members:
+            members[member.id] = member.display_name
+            bump_data_version()
+
+    def remove(self, guild_id, user_id):
+        members = self.guilds.get(guild_id)
+        if members and members.pop(user_id, None) is not None:
+            bump_data_version()
+
+    def remove_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        user_ids = [user_id for user_id, user_guild_id in self.user_guilds.items() if user_guild_id == guild_id]
+        for user_id in user_ids:
+            del self.user_guilds[user_id]
+        bump_data_version()
+        return user_ids
+
+    def is_tracked(self, guild_id, user_id):
+        return self.user_guilds.get(user_id) == guild_id
+
+    def display_name(self, user_id):
+        user_id = int(user_id)
+        return self.guilds.get(self.user_guilds.get(user_id), {}).get(user_id)
+
+    def members(self):
+        for members in self.guilds.values():
+            for user_id, display_name in members.items():
+                yield str(user_id), display_name
+
+    def get_member(self, user_id):
+        guild = bot.get_guild(self.user_guilds.get(int(user_id), 0))
+        return member_loader.get(guild, int(user_id)) if guild else None
+
+class MemberLoader:
+    # Đếm hit/miss khi tra member trong cache và tải member thiếu qua gateway (query_members, tối đa 100 người mỗi lần).
+    # Với MEMBER_CACHE_POLICY = "tracked" đây là cách duy nhất để member vào cache
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.pending = set()
+
+    def get(self, guild, user_id):
+        member = guild.get_member(user_id)
+        if member is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return member
+
+    async def load(self, guild, user_ids):
+        # Kèm presence để người đang trong game được ghi nhận ngay khi vào cache
+        user_ids = [user_id for user_id in user_ids if (guild.id, user_id) not in self.pending]
+        keys = {(guild.id, user_id) for user_id in user_ids}
+        self.pending |= keys
+        loaded = []
+        try:
+            for index in range(0, len(user_ids), 100):
+                batch = user_ids[index:index + 100]
+                try:
+                    members = await guild.query_members(user_ids=batch, limit=len(batch), presences=True, cache=True)
+                except asyncio.TimeoutError:
+                    print(f"Hết thời gian chờ tải {len(batch)} member của guild {guild.id}")
+                    continue
+                self.fetched += len(members)
+                loaded.extend(members)
+                for member in members:
+                    # Người được theo dõi nhưng lỡ lần tải lúc khởi động (vd. query bị timeout) thì đưa lại vào roster
+                    user_info = user_mapping.get(str(member.id))
+                    if user_info and user_info["guild_id"] == str(guild.id) and roster.display_name(member.id) is None:
+                        roster.add(guild.id, member.id, member.display_name)
+        finally:
+            self.pending -= keys
+        return loaded
+
+    async def load_tracked(self):
+        by_guild = defaultdict(list)
+        for user_id, user_info in user_mapping.items():
+            by_guild[int(user_info["guild_id"])].append(int(user_id))
+        for guild_id, user_ids in by_guild.items():
+            guild = bot.get_guild(guild_id)
+            if guild:
+                await self.load(guild, [user_id for user_id in user_ids if guild.get_member(user_id) is None])
+
+    def resident(self):
+        return sum(len(guild.members) for guild in bot.guilds)
+
+member_loader = MemberLoader()
+
+def remove_users(user_ids):
+    removed = [user_id for user_id in user_ids if user_mapping.pop(user_id, None) is not None]
+    if removed:
+        save_user_mapping(user_mapping, *removed)
+
 def has_admin_role(member):
     for role in member.roles:
         if str(role.id) in ADMIN_ROLE_IDS:
@@ -77,389 +1419,883 @@ def has_admin_role(member):
 start_times = {}
 online_start_times = {}
 paused_online_times = {}
+session_maps = {"game": start_times, "online": online_start_times, "paused": paused_online_times}
+restore_sessions()
 playtime_data = load_playtime_data()
+leaderboard = build_leaderboard()
+retention = RetentionEngine()
+retention.rebuild(playtime_data)
 activity_data = load_activity_data()
 user_mapping = load_user_mapping()
+zone_users = {user_id for user_id, info in activity_data.items() if info.get("zones")}
+roster = RosterIndex()
+
+class EventRecorder:
+    # Mỗi dòng một sự kiện JSON: "e" = "p" (presence) hoặc "c" (lệnh), "t" = epoch giây.
+    # Ghi trên persist_executor nên event loop không phải chờ đĩa
+    def __init__(self, path, max_bytes, backups, hash_ids):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.hash_ids = hash_ids
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def user_id(self, user_id):
+        if not self.hash_ids:
+            return user_id
+        digest = hashlib.sha256(f"{EVENT_LOG_SALT}:{user_id}".encode()).hexdigest()
+        return int(digest[:15], 16)
+
+    def member_fields(self, member):
+        user_id = self.user_id(member.id)
+        name = f"user{user_id}" if self.hash_ids else member.name
+        display_name = f"user{user_id}" if self.hash_ids else member.display_name
+        return {"u": user_id, "g": member.guild.id if member.guild else None, "n": name, "d": display_name}
+
+    def presence(self, member):
+        record = self.member_fields(member)
+        record.update({
+            "e": "p",
+            "t": time.time(),
+            "s": str(member.status),
+            # Phần tử cuối là tên lớp activity: ActivityClassifier chỉ xét Game/Activity nên replay.py cần biết để dựng lại đúng
+            "a": [
+                [
+                    activity.type.value, activity.name, getattr(activity, "state", None), getattr(activity, "details", None),
+                    type(activity).__name__,
+                ]
+                for activity in member.activities
+            ],
+        })
+        self.write(record)
+
+    def command(self, ctx):
+        record = self.member_fields(ctx.author)
+        args = [self.argument(value) for value in ctx.args[2 if ctx.command.cog else 1:]]
+        record.update({
+            "e": "c",
+            "t": ctx.message.created_at.timestamp() if ctx.message else time.time(),
+            "c": ctx.command.qualified_name,
+            "r": [str(role.id) for role in ctx.author.roles if str(role.id) in ADMIN_ROLE_IDS],
+            "x": args,
+            "k": {key: self.argument(value) for key, value in ctx.kwargs.items()},
+        })
+        self.write(record)
+
+    def argument(self, value):
+        if isinstance(value, (discord.Member, discord.User)):
+            return {"m": self.user_id(value.id)}
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        return str(value)
+
+    def write(self, record):
+        persist_executor.submit(self.append, json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n")
+
+    def append(self, line):
+        data = line.encode()
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.size = 0
+
+event_recorder = EventRecorder(EVENT_LOG_FILE, EVENT_LOG_MAX_BYTES, EVENT_LOG_BACKUPS, EVENT_LOG_HASH_IDS) if EVENT_LOG_FILE else None
 
 @bot.event
+@measured("handler", "handler")
 async def on_ready():
     print(f"Bot đã sẵn sàng: {bot.user}")
-    check_vinewood_activity.start()
-    daily_report.start()
-    reset_weekly_data.start()
-
-@tasks.loop(minutes=1)
-async def check_vinewood_activity():
-    global playtime_data, activity_data
-    current_time = datetime.now(VN_TIMEZONE)
-    channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-    if not channel:
-        print(f"Không tìm thấy kênh chat với ID {NOTIFICATION_CHANNEL_ID}")
-        return
-
-    users_to_remove = []
+    if MEMBER_CACHE_POLICY != "all":
+        await member_loader.load_tracked()
+    remove_users(roster.rebuild())
+    scheduler.start()
+    await start_metrics_server()
 
-    for user_id in list(user_mapping.keys()):
-        if user_id not in user_mapping:
-            continue
+@bot.event
+@measured("handler", "handler")
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        roster.update(after)
 
-        user_info = user_mapping[user_id]
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
+@bot.event
+@measured("handler", "handler")
+async def on_member_join(member):
+    if roster.is_tracked(member.guild.id, member.id):
+        roster.add(member.guild.id, member.id, member.display_name)
 
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
+@bot.event
+@measured("handler", "handler")
+async def on_member_remove(member):
+    roster.remove(member.guild.id, member.id)
 
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
+@bot.event
+@measured("handler", "handler")
+async def on_guild_remove(guild):
+    user_ids = roster.remove_guild(guild.id)
+    remove_users([str(user_id) for user_id in user_ids])
 
-        vinewood_active = False
-        for activity in member.activities:
-            if isinstance(activity, discord.Game) or isinstance(activity, discord.Activity):
-                activity_text = f"{activity.name} {activity.state or ''} {activity.details or ''}"
-                if "Vinewood Park Dr" in activity_text:
-                    vinewood_active = True
-                    break
+@bot.event
+async def on_command_completion(ctx):
+    # Lệnh đo đạc không đổi dữ liệu và chỉ làm replay.py phải chờ theo thời gian thật
+    if event_recorder and ctx.command.name not in ("profile", "memtrace"):
+        event_recorder.command(ctx)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_metrics(ctx):
+    labels = (("command", ctx.command.qualified_name),)
+    metrics.observe("command_seconds", time.perf_counter() - ctx.metrics_started, labels)
+    metrics.inc("commands_total", labels)
+    if ctx.command_failed:
+        metrics.inc("command_errors_total", labels)
+
+async def serve_metrics(reader, writer):
+    # HTTP tối giản: chỉ đọc dòng request rồi trả về số liệu dạng text của Prometheus
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body = metrics.render_prometheus().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
-        if user_id not in activity_data:
-            activity_data[user_id] = {}
-
-        if vinewood_active and not activity_data[user_id].get("in_vinewood", False):
-            activity_data[user_id]["in_vinewood"] = True
-            activity_data[user_id]["vinewood_start_time"] = current_time.isoformat()
-            save_activity_data(activity_data)
-            await channel.send(
-                f"{member.display_name} đã vào khu vực Vinewood Park Dr lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}."
-            )
-
-        elif not vinewood_active and activity_data[user_id].get("in_vinewood", False):
-            start_time_str = activity_data[user_id].get("vinewood_start_time")
-            if start_time_str:
-                start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
-                time_spent_seconds = (current_time - start_time).total_seconds()
-                hours = int(time_spent_seconds // 3600)
-                minutes = int((time_spent_seconds % 3600) // 60)
-                seconds = int(time_spent_seconds % 60)
-                await channel.send(
-                    f"{member.display_name} đã rời khỏi khu vực Vinewood Park Dr sau {hours} giờ {minutes} phút {seconds} giây "
-                    f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}."
-                )
-            
-            activity_data[user_id]["in_vinewood"] = False
-            activity_data[user_id]["vinewood_start_time"] = None
-            save_activity_data(activity_data)
-
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
-
-@tasks.loop(minutes=1)
-async def daily_report():
-    current_time = datetime.now(VN_TIMEZONE)
-    current_date = current_time.date()
-    current_hour = current_time.hour
-    current_minute = current_time.minute
+metrics_server = None
 
-    if current_hour != 23 or current_minute != 59:
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT is None or metrics_server is not None:
         return
-
-    channel = bot.get_channel(REPORT_CHANNEL_ID)
-    if not channel:
+    metrics_server = await asyncio.start_server(serve_metrics, "127.0.0.1", METRICS_PORT)
+    print(f"Số liệu Prometheus tại http://127.0.0.1:{METRICS_PORT}/metrics")
+
+# Thread riêng cho !profile/!memtrace: lấy mẫu stack và dựng báo cáo không chặn event loop, cũng không chen vào hàng ghi dữ liệu
+diagnostics_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diagnostics")
+diagnostics_lock = asyncio.Lock()
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+def sample_stacks(thread_id, seconds, interval):
+    # Chụp stack của thread event loop theo chu kỳ: "own" là hàm đang chạy, "total" là mọi hàm có mặt trong stack.
+    # Chỉ chụp được khi loop nhả GIL nên các đoạn chạy ngắn hơn sys.getswitchinterval() dễ bị bỏ sót; cần số lần gọi chính xác thì dùng cprofile
+    own = Counter()
+    total = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            own[frame_label(frame.f_code)] += 1
+            seen = set()
+            while frame is not None:
+                label = frame_label(frame.f_code)
+                if label not in seen:
+                    seen.add(label)
+                    total[label] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    return samples, own, total
+
+def render_samples(seconds, samples, own, total):
+    lines = [f"Lấy mẫu stack event loop trong {seconds} giây, {samples} mẫu (mỗi {PROFILE_SAMPLE_INTERVAL * 1000:g} ms)", ""]
+    for title, counter in (("Đang chạy trực tiếp (self)", own), ("Có mặt trong stack (cumulative)", total)):
+        lines.append(f"== {title} ==")
+        lines.append(f"{'mẫu':>8} {'%':>6}  hàm")
+        for label, count in counter.most_common(PROFILE_TOP):
+            lines.append(f"{count:>8} {count / samples * 100 if samples else 0:>6.1f}  {label}")
+        lines.append("")
+    return "\n".join(lines)
+
+def render_cprofile(seconds, profiler):
+    stream = io.StringIO()
+    stream.write(f"cProfile event loop trong {seconds} giây\n")
+    stats = pstats.Stats(profiler, stream=stream).strip_dirs()
+    for key in ("cumulative", "tottime"):
+        stream.write(f"\n== Sắp theo {key} ==\n")
+        stats.sort_stats(key).print_stats(PROFILE_TOP)
+    return stream.getvalue()
+
+def render_memtrace(seconds, before, after, current, peak):
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    before = before.filter_traces(ignore)
+    after = after.filter_traces(ignore)
+    lines = [
+        f"tracemalloc: chênh lệch bộ nhớ sau {seconds} giây",
+        f"Đang theo dõi {current / 1024:.1f} KiB, đỉnh {peak / 1024:.1f} KiB",
+        "",
+        "== Tăng nhiều nhất theo dòng ==",
+    ]
+    lines.extend(str(stat) for stat in after.compare_to(before, "lineno")[:PROFILE_TOP])
+    lines.extend(["", "== Tăng nhiều nhất theo stack =="])
+    for stat in after.compare_to(before, "traceback")[:10]:
+        lines.append(f"{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} khối")
+        lines.extend(stat.traceback.format())
+        lines.append("")
+    lines.append("== Đang giữ nhiều nhất theo file ==")
+    lines.extend(str(stat) for stat in after.statistics("filename")[:PROFILE_TOP])
+    return "\n".join(lines) + "\n"
+
+async def capture_profile(seconds, mode):
+    loop = asyncio.get_running_loop()
+    if mode == "sample":
+        samples, own, total = await loop.run_in_executor(
+            diagnostics_executor, sample_stacks, threading.get_ident(), seconds, PROFILE_SAMPLE_INTERVAL
+        )
+        return await loop.run_in_executor(diagnostics_executor, render_samples, seconds, samples, own, total)
+    # cProfile gắn vào thread đang bật nó, tức thread event loop: đo mọi handler/lệnh chạy trong lúc lệnh này chờ
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    return await loop.run_in_executor(diagnostics_executor, render_cprofile, seconds, profiler)
+
+async def capture_memtrace(seconds):
+    loop = asyncio.get_running_loop()
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(MEMTRACE_FRAMES)
+    try:
+        before = await loop.run_in_executor(diagnostics_executor, tracemalloc.take_snapshot)
+        await asyncio.sleep(seconds)
+        after = await loop.run_in_executor(diagnostics_executor, tracemalloc.take_snapshot)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    return await loop.run_in_executor(diagnostics_executor, render_memtrace, seconds, before, after, current, peak)
+
+def report_file(prefix, text):
+    return discord.File(io.BytesIO(text.encode()), filename=f"{prefix}-{vn_now().strftime('%Y%m%d-%H%M%S')}.txt")
+
+async def flush_storage_loop(due):
+    await flush_storage()
+
+async def compact_journals(due):
+    if STORAGE_MODE != "journal":
         return
+    await flush_storage()
+    loop = asyncio.get_running_loop()
+    for store in stores:
+        if store.records:
+            await loop.run_in_executor(persist_executor, store.compact_from_disk)
+
+class ZoneMatcher:
+    # Gộp mẫu của mọi khu vực thành một regex duy nhất, mỗi khu vực là một lookahead có tên không chiếm ký tự,
+    # nên các mẫu chồng lên nhau (vd. "Vinewood" và "Vinewood Park Dr") đều được nhận ra, không phụ thuộc thứ tự cấu hình.
+    # Lookahead đầu tiên chỉ để finditer bỏ qua các vị trí không có mẫu nào bắt đầu
+    def __init__(self, zones):
+        self.names = list(zones)
+        alternatives = {
+            index: "|".join(re.escape(pattern) for pattern in zones[name]["patterns"])
+            for index, name in enumerate(self.names)
+            if zones[name]["patterns"]
+        }
+        if alternatives:
+            anchor = "(?=" + "|".join(alternatives.values()) + ")"
+            groups = "".join(f"(?=(?P<z{index}>{pattern}))?" for index, pattern in alternatives.items())
+            self.regex = re.compile(anchor + groups)
+        else:
+            self.regex = None
+
+    def match(self, text):
+        if self.regex is None:
+            return set()
+        zones = set()
+        for m in self.regex.finditer(text):
+            zones.update(self.names[int(group[1:])] for group, value in m.groupdict().items() if value is not None)
+        return zones
+
+class ActivityClassifier:
+    # Xác định activity có phải GTA/FiveM không và đang ở khu vực nào.
+    # Kết quả được nhớ trong LRU theo (name, state, details) vì phần lớn presence update lặp lại activity cũ
+    def __init__(self, keywords, zones, maxsize=ACTIVITY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.configure(keywords, zones)
+
+    def configure(self, keywords=None, zones=None):
+        if keywords is not None:
+            self.keywords = [keyword.lower() for keyword in keywords if keyword]
+            self.game_regex = re.compile("|".join(re.escape(keyword) for keyword in self.keywords)) if self.keywords else None
+        if zones is not None:
+            self.zone_matcher = ZoneMatcher(zones)
+        self.cache.clear()
+
+    def classify_one(self, name, state, details):
+        key = (name, state, details)
+        result = self.cache.get(key)
+        if result is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return result
+        self.misses += 1
+        activity_text = f"{name} {state or ''} {details or ''}"
+        game_active = self.game_regex is not None and self.game_regex.search(activity_text.lower()) is not None
+        result = (game_active, frozenset(self.zone_matcher.match(activity_text)))
+        self.cache[key] = result
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return result
+
+    def classify(self, activities):
+        game_active = False
+        zones = set()
+        for activity in activities:
+            if isinstance(activity, discord.Game) or isinstance(activity, discord.Activity):
+                # discord.Game không có state/details
+                activity_game, activity_zones = self.classify_one(
+                    activity.name, getattr(activity, "state", None), getattr(activity, "details", None)
+                )
+                game_active = game_active or activity_game
+                zones |= activity_zones
+        return game_active, zones
+
+activity_classifier = ActivityClassifier(GAME_KEYWORDS, ZONES)
+
+class NotificationDispatcher:
+    # Hàng đợi tin nhắn cho từng kênh. Handler chỉ đưa nội dung vào hàng đợi rồi trả về ngay,
+    # một task riêng cho mỗi kênh gộp các dòng trong NOTIFY_BATCH_SECONDS và tự chờ lại khi bị rate limit
+    def __init__(self, window):
+        self.window = window
+        self.queues = {}
+        self.workers = {}
+
+    def send(self, channel_id, content):
+        self.queues.setdefault(channel_id, deque()).append(content)
+        worker = self.workers.get(channel_id)
+        if worker is None or worker.done():
+            self.workers[channel_id] = asyncio.get_running_loop().create_task(self.run(channel_id))
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def run(self, channel_id):
+        queue = self.queues[channel_id]
+        while queue:
+            await asyncio.sleep(self.window)
+            channel = bot.get_channel(channel_id)
+            if not channel:
+                print(f"Không tìm thấy kênh chat với ID {channel_id}, bỏ {len(queue)} thông báo")
+                queue.clear()
+                return
+            while queue:
+                await self.deliver(channel, self.take_batch(queue))
+
+    def take_batch(self, queue):
+        content = queue.popleft()
+        if len(content) > MESSAGE_LIMIT:
+            queue.appendleft(content[MESSAGE_LIMIT:])
+            return content[:MESSAGE_LIMIT]
+        while queue and len(content) + 1 + len(queue[0]) <= MESSAGE_LIMIT:
+            content += "\n" + queue.popleft()
+        return content
+
+    async def deliver(self, channel, content):
+        delay = 1
+        for attempt in range(5):
+            try:
+                await channel.send(content)
+                return
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    print(f"Không gửi được thông báo vào kênh {channel.id}: {e}")
+                    return
+                retry_after = getattr(e, "retry_after", None) or delay
+                await asyncio.sleep(retry_after)
+                delay = min(delay * 2, 60)
+        print(f"Bỏ thông báo vào kênh {channel.id} sau nhiều lần bị rate limit")
+
+notifier = NotificationDispatcher(NOTIFY_BATCH_SECONDS)
+
+def paginate(lines, limit=MESSAGE_LIMIT):
+    # Gom các dòng thành trang không quá limit ký tự; dòng nào dài hơn limit thì bị cắt
+    page = ""
+    for line in lines:
+        while len(line) > limit:
+            if page:
+                yield page
+                page = ""
+            yield line[:limit]
+            line = line[limit:]
+        if len(page) + len(line) > limit:
+            yield page
+            page = ""
+        page += line
+    if page:
+        yield page
+
+class ReportPages:
+    # Trang chỉ được render khi có người cần xem tới, các trang đã render giữ lại để lật ngược
+    def __init__(self, lines):
+        self.pages = []
+        self.source = paginate(lines)
+        self.done = False
+
+    def get(self, index):
+        while len(self.pages) <= index and not self.done:
+            page = next(self.source, None)
+            if page is None:
+                self.done = True
+            else:
+                self.pages.append(page)
+        return self.pages[index] if index < len(self.pages) else None
+
+class ReportPaginator(discord.ui.View):
+    def __init__(self, pages, author_id):
+        super().__init__(timeout=PAGINATOR_TIMEOUT_SECONDS)
+        self.pages = pages
+        self.author_id = author_id
+        self.index = 0
+        self.message = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = self.pages.get(self.index + 1) is None
+        total = f"/{len(self.pages.pages)}" if self.pages.done else ""
+        self.position.label = f"Trang {self.index + 1}{total}"
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Chỉ người gọi lệnh mới lật trang được.", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction):
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.pages.get(self.index), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.index -= 1
+        await self.show(interaction)
+
+    @discord.ui.button(label="Trang 1", style=discord.ButtonStyle.secondary, disabled=True)
+    async def position(self, interaction, button):
+        pass
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        self.index += 1
+        await self.show(interaction)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+async def send_report(ctx, pages):
+    # Một trang thì gửi thẳng, nhiều trang thì gửi trang đầu kèm nút lật trang
+    first = pages.get(0)
+    if pages.get(1) is None:
+        await ctx.send(first)
+        return
+    view = ReportPaginator(pages, ctx.author.id)
+    view.message = await ctx.send(first, view=view)
+
+async def stream_report(channel, pages):
+    # Dùng cho báo cáo tự động: không có ai bấm nút nên gửi lần lượt từng trang
+    index = 0
+    while True:
+        page = pages.get(index)
+        if page is None:
+            return
+        await channel.send(page)
+        index += 1
+
+def send_zone_message(zone, content):
+    notifier.send(ZONES.get(zone, {}).get("channel_id", NOTIFICATION_CHANNEL_ID), content)
+
+def enter_zone(user_id, zone, display_name, current_time):
+    activity_data.setdefault(user_id, {}).setdefault("zones", {})[zone] = current_time.isoformat()
+    zone_users.add(user_id)
+    save_activity_data(activity_data, user_id)
+    send_zone_message(
+        zone, f"{display_name} đã vào khu vực {zone} lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}."
+    )
 
-    report = f"📊 **Báo cáo on-duty ngày {current_date}**:\n"
-    users_reported = 0
-
-    users_to_remove = []
-
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
+def leave_zone(user_id, zone, display_name, current_time, reason=""):
+    zones = activity_data.get(user_id, {}).get("zones", {})
+    start_time_str = zones.pop(zone, None)
+    if not zones:
+        zone_users.discard(user_id)
+    save_activity_data(activity_data, user_id)
+    if start_time_str:
+        start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
+        account_interval(user_id, start_time, current_time, f"zone:{zone}")
+        time_spent_seconds = (current_time - start_time).total_seconds()
+        hours = int(time_spent_seconds // 3600)
+        minutes = int((time_spent_seconds % 3600) // 60)
+        seconds = int(time_spent_seconds % 60)
+        send_zone_message(
+            zone,
+            f"{display_name} đã rời khỏi khu vực {zone} sau {hours} giờ {minutes} phút {seconds} giây "
+            f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}{reason}."
+        )
 
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
+def update_zones(user_id, display_name, zones, current_time, reason=""):
+    current_zones = activity_data.get(user_id, {}).get("zones", {})
+    for zone in [zone for zone in current_zones if zone not in zones]:
+        leave_zone(user_id, zone, display_name, current_time, reason)
+    for zone in zones:
+        if zone not in current_zones:
+            enter_zone(user_id, zone, display_name, current_time)
+
+def reconcile_zones(full=False):
+    # Việc vào/ra khu vực được bắt trong on_presence_update; hàm này chỉ sửa các sự kiện bị lỡ.
+    # Mặc định chỉ kiểm tra người đang trong khu vực hoặc đang chơi game, full=True quét toàn bộ danh sách
+    current_time = vn_now()
+    if full:
+        candidates = list(user_mapping.keys())
+    else:
+        candidates = [user_id for user_id in zone_users | start_times.keys() if user_id in user_mapping]
 
-        member = guild.get_member(int(user_id))
+    for user_id in candidates:
+        member = roster.get_member(user_id)
         if not member:
             continue
 
-        total_online = 0
-        if user_id in playtime_data and "daily_online" in playtime_data[user_id]:
-            current_date_str = current_date.isoformat()
-            total_online = playtime_data[user_id]["daily_online"].get(current_date_str, 0)
-
-        if total_online > 0:
-            hours = int(total_online // 60)
-            mins = int(total_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m\n"
-            users_reported += 1
-
-    if users_reported == 0:
-        report += "Không có ai on-duty trong ngày hôm nay.\n"
+        _, zones = activity_classifier.classify(member.activities)
+        update_zones(user_id, member.display_name, zones, current_time)
 
-    await channel.send(report)
+zone_full_sweep_done = False
 
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+async def check_zone_activity(due):
+    # Lần chạy đầu sau khi khởi động quét toàn bộ vì Discord không gửi lại presence của người đang trong game
+    global zone_full_sweep_done
+    reconcile_zones(full=not zone_full_sweep_done)
+    zone_full_sweep_done = True
 
-@tasks.loop(hours=24)
-async def reset_weekly_data():
-    current_time = datetime.now(VN_TIMEZONE)
-    current_date = current_time.date()
+async def daily_report(due):
+    # due là mốc 23:59 của ngày cần báo cáo; khi bù sau thời gian bot tắt thì có thể là ngày đã qua
+    report_date = due.date()
 
-    if current_date.weekday() != 0:
+    channel = bot.get_channel(REPORT_CHANNEL_ID)
+    if not channel:
         return
 
-    two_weeks_ago = (current_time - timedelta(days=14)).date().isoformat()
-    for user_id in playtime_data:
-        if "weekly_online" in playtime_data[user_id]:
-            playtime_data[user_id]["weekly_online"] = {
-                week: minutes
-                for week, minutes in playtime_data[user_id]["weekly_online"].items()
-                if week >= two_weeks_ago
-            }
-
-        if "daily_online" in playtime_data[user_id]:
-            playtime_data[user_id]["daily_online"] = {
-                date: minutes
-                for date, minutes in playtime_data[user_id]["daily_online"].items()
-                if date >= two_weeks_ago
-            }
+    if report_date == vn_now().date():
+        empty = "Không có ai on-duty trong ngày hôm nay.\n"
+    else:
+        empty = f"Không có ai on-duty trong ngày {report_date}.\n"
+
+    online_totals = await query_online_totals(report_date, report_date)
+    await stream_report(channel, ReportPages(online_report_lines(
+        online_totals,
+        f"📊 **Báo cáo on-duty ngày {report_date}**:\n",
+        empty,
+    )))
+
+async def enforce_retention(due):
+    touched, removed = await retention.run(vn_now().date())
+    if touched or removed:
+        print(f"Đã dọn dữ liệu hết hạn: {touched} người được cắt bớt, {removed} người bị xóa")
+
+def every(seconds):
+    return lambda after: after + timedelta(seconds=seconds)
+
+def daily_at(hour, minute, weekday=None):
+    # Lần chạy kế tiếp sau after vào hour:minute giờ Việt Nam, weekday=0 là Thứ 2
+    def next_run(after):
+        after = after.astimezone(VN_TIMEZONE)
+        day = after.date()
+        while True:
+            due = VN_TIMEZONE.localize(datetime(day.year, day.month, day.day, hour, minute))
+            if due > after and (weekday is None or day.weekday() == weekday):
+                return due
+            day += timedelta(days=1)
+    return next_run
+
+class ScheduledJob:
+    __slots__ = ("name", "func", "next_run", "catch_up", "task")
+
+    def __init__(self, name, func, next_run, catch_up):
+        self.name = name
+        self.func = func
+        self.next_run = next_run
+        self.catch_up = catch_up
+        self.task = None
+
+class Scheduler:
+    # Một task duy nhất ngủ tới hạn của job sớm nhất trong heap, thay cho các tasks.loop thức dậy theo phút.
+    # Job có catch_up > 0 được lưu mốc chạy gần nhất vào file; khi khởi động lại, tối đa catch_up lần bị lỡ được chạy bù
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self.heap = []
+        self.sequence = 0
+        self.last_runs = {}
+        self.task = None
+
+    def add(self, name, func, next_run, catch_up=0):
+        self.jobs[name] = ScheduledJob(name, func, next_run, catch_up)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.last_runs = json.load(f)
+        except (OSError, ValueError):
+            self.last_runs = {}
 
-    save_playtime_data(playtime_data)
+    def write(self, text):
+        # Chạy trên persist_executor, future bị bỏ qua nên lỗi phải được in ra ở đây
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Lỗi khi ghi {self.path}: {e}")
+
+    def push(self, due, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, job.name))
+
+    def start(self):
+        # on_ready có thể được gọi lại sau mỗi lần kết nối lại
+        if self.task is not None and not self.task.done():
+            return
+        self.load()
+        now = vn_now()
+        self.heap = []
+        for job in self.jobs.values():
+            missed = []
+            last_run = self.last_runs.get(job.name)
+            if job.catch_up and last_run:
+                due = job.next_run(datetime.fromisoformat(last_run))
+                while due <= now:
+                    missed.append(due)
+                    due = job.next_run(due)
+                missed = missed[-job.catch_up:]
+            elif job.catch_up:
+                # Lần đầu chạy: lấy thời điểm khởi động làm mốc để lần tắt sau vẫn bù được
+                self.last_runs[job.name] = now.isoformat()
+                persist_executor.submit(self.write, json.dumps(self.last_runs))
+            if missed:
+                print(f"Chạy bù {len(missed)} lần {job.name} bị lỡ")
+                job.task = asyncio.get_running_loop().create_task(self.run_job(job, missed))
+            # Job không theo lịch chạy ngay khi khởi động, giống tasks.loop trước đây
+            self.push(job.next_run(now) if job.catch_up else now, job)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while self.heap:
+            due, _, name = self.heap[0]
+            delay = (due - vn_now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self.heap)
+            # Độ trễ so với hạn chạy cho biết event loop bị nghẽn bao lâu
+            metrics.observe("loop_lag_seconds", max(0.0, (vn_now() - due).total_seconds()))
+            job = self.jobs[name]
+            if job.task is not None and not job.task.done():
+                # Lần chạy trước chưa xong thì bỏ qua lần này
+                print(f"{job.name} vẫn đang chạy, bỏ qua lần {due}")
+            else:
+                job.task = asyncio.get_running_loop().create_task(self.run_job(job, [due]))
+            now = vn_now()
+            next_due = job.next_run(due)
+            if next_due <= now and not job.catch_up:
+                next_due = job.next_run(now)
+            self.push(next_due, job)
+
+    async def run_job(self, job, dues):
+        for due in dues:
+            try:
+                await job.func(due)
+            except Exception:
+                print(f"Lỗi khi chạy {job.name} ({due}):")
+                traceback.print_exc()
+            if job.catch_up:
+                self.last_runs[job.name] = due.isoformat()
+                persist_executor.submit(self.write, json.dumps(self.last_runs))
+
+scheduler = Scheduler(SCHEDULE_FILE)
+scheduler.add("flush_storage", flush_storage_loop, every(FLUSH_INTERVAL_SECONDS))
+scheduler.add("compact_journals", compact_journals, every(JOURNAL_COMPACT_MINUTES * 60))
+scheduler.add("check_zone_activity", check_zone_activity, every(ZONE_RECONCILE_MINUTES * 60))
+scheduler.add("daily_report", daily_report, daily_at(23, 59), catch_up=RETENTION_WINDOWS["online"])
+scheduler.add("enforce_retention", enforce_retention, every(RETENTION_INTERVAL_MINUTES * 60))
+
+class PresenceWorkerPool:
+    def __init__(self, handler, workers, maxsize):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queues = []
+        self.tasks = []
+
+    def start(self):
+        self.queues = [asyncio.Queue(self.maxsize) for _ in range(self.workers)]
+        self.tasks = [asyncio.get_running_loop().create_task(self.run(queue)) for queue in self.queues]
+
+    async def submit(self, user_id, *args):
+        if not self.tasks:
+            self.start()
+        queue = self.queues[user_id % self.workers]
+        item = (time.perf_counter(), args)
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Hàng đợi đầy: chờ để giữ thứ tự thay vì bỏ sự kiện
+            metrics.inc("presence_blocked_total")
+            await queue.put(item)
+
+    async def run(self, queue):
+        while True:
+            enqueued, args = await queue.get()
+            started = time.perf_counter()
+            try:
+                await self.handler(*args)
+            except Exception:
+                traceback.print_exc()
+            metrics.observe("presence_queue_wait_seconds", started - enqueued)
+            metrics.observe("presence_handle_seconds", time.perf_counter() - started)
+            queue.task_done()
+
+def presence_fingerprint(user_id, game_active, zones, status):
+    # Những gì bot thực sự theo dõi; đổi trạng thái online/idle hay chi tiết Rich Presence không làm đổi giá trị này
+    return (
+        game_active,
+        frozenset(zones),
+        status == discord.Status.offline,
+        user_id in online_start_times,
+        user_id in user_mapping,
+    )
 
 @bot.event
+@measured("handler", "handler")
 async def on_presence_update(before, after):
+    # Chỉ ghi nhận thời điểm nhận sự kiện rồi giao cho worker, handler của gateway trả về ngay.
+    # Sự kiện không làm đổi trạng thái (kể cả bản lặp lại từ các guild khác) bị bỏ qua ở đây
+    if event_recorder:
+        event_recorder.presence(after)
+    game_active, zones = activity_classifier.classify(after.activities)
+    fingerprint = presence_fingerprint(str(after.id), game_active, zones, after.status)
+    if presence_fingerprints.get(after.id) == fingerprint:
+        metrics.inc("presence_dropped_duplicates_total")
+        return
+    if after.status == discord.Status.offline and str(after.id) not in user_mapping:
+        # Người không được theo dõi đã offline thì không cần nhớ, tránh bảng lớn dần theo số thành viên của guild
+        presence_fingerprints.pop(after.id, None)
+    else:
+        presence_fingerprints[after.id] = fingerprint
+    # discord.py sửa trực tiếp Member trong cache ở sự kiện sau, nên chụp lại các giá trị cần dùng ngay lúc nhận
+    guild_id = after.guild.id if after.guild else None
+    await presence_workers.submit(
+        after.id, after.id, guild_id, after.name, after.display_name, after.status, vn_now(), game_active, zones
+    )
+
+@bot.event
+@measured("handler", "handler")
+async def on_raw_presence_update(payload):
+    # Chỉ được gọi khi MEMBER_CACHE_POLICY = "tracked". Người đã có trong cache đi tiếp qua on_presence_update;
+    # người chưa có chỉ được tải về khi đang được theo dõi hoặc đang chơi game, những người còn lại bỏ qua
+    if payload.guild is None or member_loader.get(payload.guild, payload.user_id) is not None:
+        return
+    if str(payload.user_id) not in user_mapping and not activity_classifier.classify(payload.activities)[0]:
+        return
+    members = await member_loader.load(payload.guild, [payload.user_id])
+    if members:
+        await on_presence_update(members[0], members[0])
+
+async def handle_presence_update(member_id, guild_id, name, display_name, status, current_time, game_active, zones):
     global start_times, online_start_times, paused_online_times, playtime_data, activity_data, user_mapping
-    user_id = str(after.id)
-    current_time = datetime.now(VN_TIMEZONE)
-    current_date = current_time.date().isoformat()
-
-    game_active = False
-    for activity in after.activities:
-        if isinstance(activity, discord.Game) or isinstance(activity, discord.Activity):
-            activity_name = str(activity.name).lower()
-            activity_text = f"{activity.name} {activity.state or ''} {activity.details or ''}".lower()
-            if any(keyword in activity_name for keyword in ["gta5vn.net", "gta5vn", "gta v", "gta 5", "fivem"]) or \
-               any(keyword in activity_text for keyword in ["gta5vn.net", "gta5vn", "gta v", "gta 5", "fivem"]):
-                game_active = True
-                break
+    user_id = str(member_id)
 
     if game_active and user_id not in user_mapping:
-        guild_id = str(after.guild.id) if after.guild else None
         if guild_id:
-            user_mapping[user_id] = {"guild_id": guild_id}
-            save_user_mapping(user_mapping)
-            channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-            if channel:
-                await channel.send(f"Người chơi {after.name} đã được tự động thêm vào danh sách.")
-
-    if user_id not in activity_data:
-        activity_data[user_id] = {}
+            user_mapping[user_id] = {"guild_id": str(guild_id)}
+            save_user_mapping(user_mapping, user_id)
+            roster.add(guild_id, member_id, display_name)
+            notifier.send(NOTIFICATION_CHANNEL_ID, f"Người chơi {name} đã được tự động thêm vào danh sách.")
 
     if game_active:
         if user_id not in start_times:
-            start_times[user_id] = current_time
+            begin_session("game", user_id, current_time)
 
-    if not game_active:
-        if user_id in start_times:
-            start_time = start_times.pop(user_id)
-            time_played = (current_time - start_time).total_seconds() / 60
-
-            if user_id not in playtime_data:
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            last_reset = datetime.fromisoformat(playtime_data[user_id]["last_reset"]).astimezone(VN_TIMEZONE)
-            if current_time - last_reset > timedelta(days=14):
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            if current_date not in playtime_data[user_id]["daily_playtime"]:
-                playtime_data[user_id]["daily_playtime"][current_date] = 0
-            playtime_data[user_id]["daily_playtime"][current_date] += time_played
-
-            fourteen_days_ago = (current_time - timedelta(days=14)).date().isoformat()
-            playtime_data[user_id]["daily_playtime"] = {
-                date: minutes
-                for date, minutes in playtime_data[user_id]["daily_playtime"].items()
-                if date >= fourteen_days_ago
-            }
+        if status != discord.Status.offline and user_id in user_mapping:
+            update_zones(user_id, display_name, zones, current_time)
 
-            save_playtime_data(playtime_data)
-
-        if user_id in activity_data:
-            if activity_data[user_id].get("in_vinewood", False):
-                start_time_str = activity_data[user_id].get("vinewood_start_time")
-                if start_time_str:
-                    start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
-                    time_spent_seconds = (current_time - start_time).total_seconds()
-                    hours = int(time_spent_seconds // 3600)
-                    minutes = int((time_spent_seconds % 3600) // 60)
-                    seconds = int(time_spent_seconds % 60)
-                    channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-                    if channel:
-                        await channel.send(
-                            f"{after.name} đã rời khỏi khu vực Vinewood Park Dr sau {hours} giờ {minutes} phút {seconds} giây "
-                            f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} do thoát game."
-                        )
-            activity_data[user_id]["in_vinewood"] = False
-            activity_data[user_id]["vinewood_start_time"] = None
-            save_activity_data(activity_data)
-
-        if user_id in paused_online_times:
-            del paused_online_times[user_id]
-
-    if after.status == discord.Status.offline:
-        if user_id in start_times:
-            start_time = start_times.pop(user_id)
-            time_played = (current_time - start_time).total_seconds() / 60
-
-            if user_id not in playtime_data:
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            last_reset = datetime.fromisoformat(playtime_data[user_id]["last_reset"]).astimezone(VN_TIMEZONE)
-            if current_time - last_reset > timedelta(days=14):
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            if current_date not in playtime_data[user_id]["daily_playtime"]:
-                playtime_data[user_id]["daily_playtime"][current_date] = 0
-            playtime_data[user_id]["daily_playtime"][current_date] += time_played
-
-            fourteen_days_ago = (current_time - timedelta(days=14)).date().isoformat()
-            playtime_data[user_id]["daily_playtime"] = {
-                date: minutes
-                for date, minutes in playtime_data[user_id]["daily_playtime"].items()
-                if date >= fourteen_days_ago
-            }
+    if not game_active:
+        if session_open_at("game", user_id, current_time):
+            start_time = end_session("game", user_id)
+            account_interval(user_id, start_time, current_time, "playtime")
 
-            save_playtime_data(playtime_data)
+        if user_id in zone_users:
+            update_zones(user_id, name, (), current_time, " do thoát game")
 
-        if user_id in online_start_times:
-            start_time = online_start_times[user_id]
-            time_online = (current_time - start_time).total_seconds() / 60
-
-            if user_id not in playtime_data:
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            last_reset = datetime.fromisoformat(playtime_data[user_id]["last_reset"]).astimezone(VN_TIMEZONE)
-            if current_time - last_reset > timedelta(days=14):
-                playtime_data[user_id] = {
-                    "daily_playtime": {},
-                    "daily_online": {},
-                    "weekly_online": {},
-                    "last_reset": current_time.isoformat()
-                }
-
-            # Chia thời gian on-duty theo ngày
-            current_date = start_time
-            while current_date.date() <= current_time.date():
-                date_str = current_date.date().isoformat()
-                if date_str not in playtime_data[user_id]["daily_online"]:
-                    playtime_data[user_id]["daily_online"][date_str] = 0
-
-                if current_date.date() == current_time.date():
-                    end_of_period = current_time
-                else:
-                    end_of_period = datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1)
-
-                if current_date.date() == start_time.date():
-                    start_of_period = start_time
-                else:
-                    start_of_period = datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE)
-
-                time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-                playtime_data[user_id]["daily_online"][date_str] += time_in_day
-
-                current_week_start, _ = get_week_boundaries(current_date.date())
-                week_key = current_week_start.isoformat()
-                if "weekly_online" not in playtime_data[user_id]:
-                    playtime_data[user_id]["weekly_online"] = {}
-                if week_key not in playtime_data[user_id]["weekly_online"]:
-                    playtime_data[user_id]["weekly_online"][week_key] = 0
-                playtime_data[user_id]["weekly_online"][week_key] += time_in_day
-
-                current_date = current_date + timedelta(days=1)
-
-            fourteen_days_ago = (current_time - timedelta(days=14)).date().isoformat()
-            playtime_data[user_id]["daily_online"] = {
-                date: minutes
-                for date, minutes in playtime_data[user_id]["daily_online"].items()
-                if date >= fourteen_days_ago
-            }
+        if session_open_at("paused", user_id, current_time):
+            end_session("paused", user_id)
 
-            two_weeks_ago = (current_time - timedelta(days=14)).date().isoformat()
-            playtime_data[user_id]["weekly_online"] = {
-                week: minutes
-                for week, minutes in playtime_data[user_id]["weekly_online"].items()
-                if week >= two_weeks_ago
-            }
+    if status == discord.Status.offline:
+        if session_open_at("game", user_id, current_time):
+            start_time = end_session("game", user_id)
+            account_interval(user_id, start_time, current_time, "playtime")
 
-            save_playtime_data(playtime_data)
-            del online_start_times[user_id]
-
-        if user_id in activity_data:
-            if activity_data[user_id].get("in_vinewood", False):
-                start_time_str = activity_data[user_id].get("vinewood_start_time")
-                if start_time_str:
-                    start_time = datetime.fromisoformat(start_time_str).astimezone(VN_TIMEZONE)
-                    time_spent_seconds = (current_time - start_time).total_seconds()
-                    hours = int(time_spent_seconds // 3600)
-                    minutes = int((time_spent_seconds % 3600) // 60)
-                    seconds = int(time_spent_seconds % 60)
-                    channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-                    if channel:
-                        await channel.send(
-                            f"{after.name} đã rời khỏi khu vực Vinewood Park Dr sau {hours} giờ {minutes} phút {seconds} giây "
-                            f"vào lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')} do offline."
-                        )
-            activity_data[user_id]["in_vinewood"] = False
-            activity_data[user_id]["vinewood_start_time"] = None
-            save_activity_data(activity_data)
-
-        if user_id in paused_online_times:
-            del paused_online_times[user_id]
+        if session_open_at("online", user_id, current_time):
+            start_time = online_start_times[user_id]
+            account_interval(user_id, start_time, current_time)
+            end_session("online", user_id)
+
+        if user_id in zone_users:
+            update_zones(user_id, name, (), current_time, " do offline")
+
+        if session_open_at("paused", user_id, current_time):
+            end_session("paused", user_id)
+
+presence_workers = PresenceWorkerPool(handle_presence_update, PRESENCE_WORKERS, PRESENCE_QUEUE_SIZE)
+presence_fingerprints = {}
+
+metrics.gauge("presence_queue_depth", lambda: sum(queue.qsize() for queue in presence_workers.queues))
+metrics.gauge("presence_fingerprints", lambda: len(presence_fingerprints))
+metrics.gauge("presence_queue_depth_max", lambda: max((queue.qsize() for queue in presence_workers.queues), default=0))
+metrics.gauge("notification_queue_depth", lambda: notifier.queue_depth())
+metrics.gauge("storage_pending_keys", lambda: sum(store.pending_count() for store in stores))
+metrics.gauge("tracked_users", lambda: len(user_mapping))
+metrics.gauge("playtime_records", lambda: len(playtime_data))
+metrics.gauge("report_cache_entries", lambda: len(report_cache))
+metrics.counter("activity_cache_hits_total", lambda: activity_classifier.hits)
+metrics.counter("activity_cache_misses_total", lambda: activity_classifier.misses)
+metrics.gauge("members_resident", member_loader.resident)
+metrics.counter("member_cache_hits_total", lambda: member_loader.hits)
+metrics.counter("member_cache_misses_total", lambda: member_loader.misses)
+metrics.counter("members_fetched_total", lambda: member_loader.fetched)
+metrics.gauge("uptime_seconds", lambda: time.time() - metrics.started)
 
 @bot.command()
 async def help(ctx):
@@ -471,7 +2307,7 @@ async def help(ctx):
     is_admin = has_admin_role(ctx.author)
 
     # Lấy thời gian hiện tại theo múi giờ Việt Nam
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
     formatted_time = current_time.strftime('%H:%M:%S %d/%m/%Y')
 
     # Tạo embed cho menu help
@@ -490,12 +2326,13 @@ async def help(ctx):
             "Bắt đầu trạng thái on-duty để tính thời gian online. Chỉ cần gõ lệnh để bắt đầu.\n\n"
             "➡️ **!offduty**\n"
             "Dừng trạng thái on-duty và lưu thời gian online của bạn.\n\n"
-            "➡️ **!playtime [@user]**\n"
-            "Xem thời gian chơi GTA5VN.NET và thời gian online (on-duty) của bạn hoặc người được tag. Người dùng thường chỉ xem được tuần hiện tại.\n\n"
+            "➡️ **!playtime [@user] [tháng/năm]**\n"
+            "Xem thời gian chơi GTA5VN.NET và thời gian online (on-duty) của bạn hoặc người được tag. Người dùng thường chỉ xem được tuần hiện tại. "
+            "Thêm tháng (ví dụ: !playtime @user 1/2025) để xem lại dữ liệu cũ của cả tháng (admin hoặc chính mình).\n\n"
             "➡️ **!checktime [@user]**\n"
             "Xem tổng thời gian on-duty trong tuần hiện tại (Thứ 2 đến Chủ Nhật) của bạn hoặc người được tag.\n\n"
             "➡️ **!checkdays [ngày/tháng] hoặc [ngày/tháng-ngày/tháng]**\n"
-            "Xem thời gian on-duty trong một ngày (ví dụ: !checkdays 25/3) hoặc trong khoảng thời gian (ví dụ: !checkdays 25/3-30/3).\n\n"
+            "Xem thời gian on-duty trong một ngày (ví dụ: !checkdays 25/3) hoặc trong khoảng thời gian (ví dụ: !checkdays 25/3-30/3, qua năm mới: !checkdays 28/12-3/1 hoặc 28/12/2024-3/1/2025). Dữ liệu cũ hơn 2 tuần được đọc từ archive.\n\n"
             "➡️ **!help**\n"
             "Hiển thị menu hướng dẫn này."
         ),
@@ -514,6 +2351,8 @@ async def help(ctx):
                 "Hiển thị lịch sử on-duty của tất cả người chơi trong tuần trước (từ Thứ 2 đến Chủ Nhật).\n\n"
                 "➡️ **!checkreg**\n"
                 "Hiển thị lịch sử on-duty của tất cả người chơi trong tuần hiện tại (từ Thứ 2 đến Chủ Nhật).\n\n"
+                "➡️ **!top [số người] [ngày/tháng]**\n"
+                "Xếp hạng thời gian on-duty trong tuần chứa ngày đã chọn (mặc định: 10 người, tuần hiện tại).\n\n"
                 "➡️ **!checkduty**\n"
                 "Hiển thị danh sách tất cả người chơi đang ở trạng thái on-duty.\n\n"
                 "➡️ **!checkoff**\n"
@@ -523,12 +2362,125 @@ async def help(ctx):
             ),
             inline=False
         )
+        # Mỗi field của embed tối đa 1024 ký tự nên các lệnh quản trị bot tách ra field riêng
+        embed.add_field(
+            name="🛠️ **Lệnh Quản Trị Bot**",
+            value=(
+                "➡️ **!gamekeywords [từ khóa 1, từ khóa 2, ...]**\n"
+                "Xem hoặc thay danh sách từ khóa nhận diện GTA5VN/FiveM, kèm số liệu cache.\n\n"
+                "➡️ **!botstats**\n"
+                "Xem số liệu vận hành: thời gian xử lý sự kiện/lệnh, thời gian ghi dữ liệu, hàng đợi, độ trễ event loop.\n\n"
+                "➡️ **!profile [số giây] [sample|cprofile]**\n"
+                "Đo CPU của bot trong thời gian chỉ định (mặc định 30 giây, sample), gửi file các hàm tốn thời gian nhất.\n\n"
+                "➡️ **!memtrace [số giây]**\n"
+                "Theo dõi cấp phát bộ nhớ trong thời gian chỉ định, gửi file các chỗ cấp phát tăng nhiều nhất."
+            ),
+            inline=False
+        )
 
     # Footer của embed với thời gian hiện tại
     embed.set_footer(text=f"Bot được tạo bởi Thowm2005 | Thời gian hiện tại: {formatted_time}")
     embed.set_thumbnail(url="https://media.discordapp.net/attachments/1354932216643190784/1354932353486819430/lapd-code3.gif?ex=67e71696&is=67e5c516&hm=2064572238be861f176127fbd23e557915c6811c3182e30e405be8134383d9e8&=")  # Thêm hình ảnh thumbnail (có thể thay đổi URL)
 
     await ctx.send(embed=embed)
+@bot.command(name="gamekeywords")
+async def gamekeywords(ctx, *, keywords: str = None):
+    if not ctx.guild:
+        await ctx.send("Lệnh !gamekeywords chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
+
+    if not has_admin_role(ctx.author):
+        await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
+        return
+
+    if keywords:
+        activity_classifier.configure(keywords=[keyword.strip() for keyword in keywords.split(",")])
+
+    total = activity_classifier.hits + activity_classifier.misses
+    hit_rate = activity_classifier.hits / total * 100 if total else 0
+    await ctx.send(
+        f"Từ khóa nhận diện game: {', '.join(activity_classifier.keywords) or '(trống)'}\n"
+        f"Cache: {len(activity_classifier.cache)}/{activity_classifier.maxsize} mục, "
+        f"{activity_classifier.hits} hit / {activity_classifier.misses} miss ({hit_rate:.1f}%)."
+    )
+
+def botstats_lines():
+    uptime = int(time.time() - metrics.started)
+    yield f"📈 **Số liệu bot** (chạy được {uptime // 3600}h {uptime % 3600 // 60}m)\n"
+    yield "\n**Trạng thái**\n"
+    counters, histograms = metrics.snapshot()
+    for name, func in sorted(list(metrics.gauges.items())):
+        if name != "uptime_seconds":
+            yield f"- {name}: {func()}\n"
+    if counters:
+        yield "\n**Bộ đếm**\n"
+    for (name, labels), value in counters:
+        yield f"- {name}{format_labels(labels)}: {value}\n"
+    yield "\n**Thời gian xử lý** (số lần, trung bình / p50 / p99 / max, ms)\n"
+    for (name, labels), histogram in histograms:
+        average = histogram.total / histogram.count * 1000 if histogram.count else 0
+        yield (
+            f"- {name}{format_labels(labels)}: {histogram.count}, {average:.2f} / {histogram.quantile(0.5) * 1000:.2f} / "
+            f"{histogram.quantile(0.99) * 1000:.2f} / {histogram.max * 1000:.2f}\n"
+        )
+
+@bot.command(name="botstats")
+async def botstats(ctx):
+    if not ctx.guild:
+        await ctx.send("Lệnh !botstats chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
+
+    if not has_admin_role(ctx.author):
+        await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
+        return
+
+    await send_report(ctx, ReportPages(botstats_lines()))
+
+@bot.command(name="profile")
+async def profile(ctx, seconds: int = PROFILE_DEFAULT_SECONDS, mode: str = "sample"):
+    if not ctx.guild:
+        await ctx.send("Lệnh !profile chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
+
+    if not has_admin_role(ctx.author):
+        await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
+        return
+
+    mode = mode.lower()
+    if mode not in ("sample", "cprofile"):
+        await ctx.send("Chế độ không hợp lệ. Dùng: `!profile [số giây] [sample|cprofile]`.")
+        return
+
+    if diagnostics_lock.locked():
+        await ctx.send("Đang có một phiên !profile hoặc !memtrace chạy, vui lòng đợi xong.")
+        return
+
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    async with diagnostics_lock:
+        await ctx.send(f"⏱️ Bắt đầu profile ({mode}) trong {seconds} giây...")
+        text = await capture_profile(seconds, mode)
+    await ctx.send(f"✅ Kết quả profile ({mode}, {seconds} giây):", file=report_file("profile", text))
+
+@bot.command(name="memtrace")
+async def memtrace(ctx, seconds: int = PROFILE_DEFAULT_SECONDS):
+    if not ctx.guild:
+        await ctx.send("Lệnh !memtrace chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
+
+    if not has_admin_role(ctx.author):
+        await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
+        return
+
+    if diagnostics_lock.locked():
+        await ctx.send("Đang có một phiên !profile hoặc !memtrace chạy, vui lòng đợi xong.")
+        return
+
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    async with diagnostics_lock:
+        await ctx.send(f"🧠 Bắt đầu theo dõi cấp phát bộ nhớ trong {seconds} giây...")
+        text = await capture_memtrace(seconds)
+    await ctx.send(f"✅ Kết quả tracemalloc ({seconds} giây):", file=report_file("memtrace", text))
+
 @bot.command()
 async def onduty(ctx):
     if not ctx.guild:
@@ -536,7 +2488,7 @@ async def onduty(ctx):
         return
 
     user_id = str(ctx.author.id)
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
 
     if user_id in online_start_times:
         start_time = online_start_times[user_id]
@@ -549,9 +2501,10 @@ async def onduty(ctx):
     if user_id not in user_mapping:
         guild_id = str(ctx.guild.id)
         user_mapping[user_id] = {"guild_id": guild_id}
-        save_user_mapping(user_mapping)
+        save_user_mapping(user_mapping, user_id)
+        roster.add(ctx.guild.id, ctx.author.id, ctx.author.display_name)
 
-    online_start_times[user_id] = current_time
+    begin_session("online", user_id, current_time)
     await ctx.send(f"{ctx.author.display_name} đã bắt đầu trạng thái on-duty lúc {current_time.strftime('%H:%M:%S %Y-%m-%d')}.")
 
 @bot.command()
@@ -561,7 +2514,7 @@ async def offduty(ctx):
         return
 
     user_id = str(ctx.author.id)
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
 
     if user_id not in online_start_times:
         await ctx.send("Bạn hiện không ở trạng thái on-duty.")
@@ -570,69 +2523,8 @@ async def offduty(ctx):
     start_time = online_start_times[user_id]
     time_online = (current_time - start_time).total_seconds() / 60
 
-    if user_id not in playtime_data:
-        playtime_data[user_id] = {
-            "daily_playtime": {},
-            "daily_online": {},
-            "weekly_online": {},
-            "last_reset": current_time.isoformat()
-        }
-
-    last_reset = datetime.fromisoformat(playtime_data[user_id]["last_reset"]).astimezone(VN_TIMEZONE)
-    if current_time - last_reset > timedelta(days=14):
-        playtime_data[user_id] = {
-            "daily_playtime": {},
-            "daily_online": {},
-            "weekly_online": {},
-            "last_reset": current_time.isoformat()
-        }
-
-    # Chia thời gian on-duty theo ngày
-    current_date = start_time
-    while current_date.date() <= current_time.date():
-        date_str = current_date.date().isoformat()
-        if date_str not in playtime_data[user_id]["daily_online"]:
-            playtime_data[user_id]["daily_online"][date_str] = 0
-
-        if current_date.date() == current_time.date():
-            end_of_period = current_time
-        else:
-            end_of_period = datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1)
-
-        if current_date.date() == start_time.date():
-            start_of_period = start_time
-        else:
-            start_of_period = datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE)
-
-        time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-        playtime_data[user_id]["daily_online"][date_str] += time_in_day
-
-        current_week_start, _ = get_week_boundaries(current_date.date())
-        week_key = current_week_start.isoformat()
-        if "weekly_online" not in playtime_data[user_id]:
-            playtime_data[user_id]["weekly_online"] = {}
-        if week_key not in playtime_data[user_id]["weekly_online"]:
-            playtime_data[user_id]["weekly_online"][week_key] = 0
-        playtime_data[user_id]["weekly_online"][week_key] += time_in_day
-
-        current_date = current_date + timedelta(days=1)
-
-    fourteen_days_ago = (current_time - timedelta(days=14)).date().isoformat()
-    playtime_data[user_id]["daily_online"] = {
-        date: minutes
-        for date, minutes in playtime_data[user_id]["daily_online"].items()
-        if date >= fourteen_days_ago
-    }
-
-    two_weeks_ago = (current_time - timedelta(days=14)).date().isoformat()
-    playtime_data[user_id]["weekly_online"] = {
-        week: minutes
-        for week, minutes in playtime_data[user_id]["weekly_online"].items()
-        if week >= two_weeks_ago
-    }
-
-    save_playtime_data(playtime_data)
-    del online_start_times[user_id]
+    account_interval(user_id, start_time, current_time)
+    end_session("online", user_id)
 
     await ctx.send(f"{ctx.author.display_name} đã dừng trạng thái on-duty. Thời gian online: {int(time_online // 60)} giờ {int(time_online % 60)} phút.")
 
@@ -647,7 +2539,7 @@ async def doffduty(ctx, member: discord.Member):
         return
 
     user_id = str(member.id)
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
 
     if user_id not in online_start_times:
         await ctx.send(f"{member.display_name} hiện không ở trạng thái on-duty.")
@@ -656,69 +2548,8 @@ async def doffduty(ctx, member: discord.Member):
     start_time = online_start_times[user_id]
     time_online = (current_time - start_time).total_seconds() / 60
 
-    if user_id not in playtime_data:
-        playtime_data[user_id] = {
-            "daily_playtime": {},
-            "daily_online": {},
-            "weekly_online": {},
-            "last_reset": current_time.isoformat()
-        }
-
-    last_reset = datetime.fromisoformat(playtime_data[user_id]["last_reset"]).astimezone(VN_TIMEZONE)
-    if current_time - last_reset > timedelta(days=14):
-        playtime_data[user_id] = {
-            "daily_playtime": {},
-            "daily_online": {},
-            "weekly_online": {},
-            "last_reset": current_time.isoformat()
-        }
-
-    # Chia thời gian on-duty theo ngày
-    current_date = start_time
-    while current_date.date() <= current_time.date():
-        date_str = current_date.date().isoformat()
-        if date_str not in playtime_data[user_id]["daily_online"]:
-            playtime_data[user_id]["daily_online"][date_str] = 0
-
-        if current_date.date() == current_time.date():
-            end_of_period = current_time
-        else:
-            end_of_period = datetime.combine(current_date.date() + timedelta(days=1), datetime.min.time(), tzinfo=VN_TIMEZONE) - timedelta(seconds=1)
-
-        if current_date.date() == start_time.date():
-            start_of_period = start_time
-        else:
-            start_of_period = datetime.combine(current_date.date(), datetime.min.time(), tzinfo=VN_TIMEZONE)
-
-        time_in_day = (end_of_period - start_of_period).total_seconds() / 60
-        playtime_data[user_id]["daily_online"][date_str] += time_in_day
-
-        current_week_start, _ = get_week_boundaries(current_date.date())
-        week_key = current_week_start.isoformat()
-        if "weekly_online" not in playtime_data[user_id]:
-            playtime_data[user_id]["weekly_online"] = {}
-        if week_key not in playtime_data[user_id]["weekly_online"]:
-            playtime_data[user_id]["weekly_online"][week_key] = 0
-        playtime_data[user_id]["weekly_online"][week_key] += time_in_day
-
-        current_date = current_date + timedelta(days=1)
-
-    fourteen_days_ago = (current_time - timedelta(days=14)).date().isoformat()
-    playtime_data[user_id]["daily_online"] = {
-        date: minutes
-        for date, minutes in playtime_data[user_id]["daily_online"].items()
-        if date >= fourteen_days_ago
-    }
-
-    two_weeks_ago = (current_time - timedelta(days=14)).date().isoformat()
-    playtime_data[user_id]["weekly_online"] = {
-        week: minutes
-        for week, minutes in playtime_data[user_id]["weekly_online"].items()
-        if week >= two_weeks_ago
-    }
-
-    save_playtime_data(playtime_data)
-    del online_start_times[user_id]
+    account_interval(user_id, start_time, current_time)
+    end_session("online", user_id)
 
     await ctx.send(f"{member.display_name} đã bị admin {ctx.author.display_name} tắt trạng thái on-duty. Thời gian online: {int(time_online // 60)} giờ {int(time_online % 60)} phút.")
 
@@ -735,7 +2566,7 @@ async def checkstatus(ctx, member: discord.Member = None):
     member = member or ctx.author
     target_user_id = str(member.id)
 
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
 
     if target_user_id in online_start_times:
         start_time = online_start_times[target_user_id]
@@ -746,30 +2577,8 @@ async def checkstatus(ctx, member: discord.Member = None):
     else:
         await ctx.send(f"{member.display_name} hiện đang ở trạng thái **off-duty**.")
 
-@bot.command()
-async def playtime(ctx, member: discord.Member = None):
-    if not ctx.guild:
-        await ctx.send("Lệnh !playtime chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
-        return
-
-    member = member or ctx.author
-    target_user_id = str(member.id)
-
-    if target_user_id not in playtime_data:
-        await ctx.send(f"{member.display_name} chưa chơi GTA5VN.NET hoặc chưa ở trạng thái on-duty trong 2 tuần qua.")
-        return
-
-    current_time = datetime.now(VN_TIMEZONE)
-    current_date = current_time.date()
-
-    current_week_start, current_week_end = get_week_boundaries(current_date)
-    previous_week_start = current_week_start - timedelta(days=7)
-    previous_week_end = current_week_end - timedelta(days=7)
-
-    has_admin = has_admin_role(ctx.author)
-    weeks_to_show = 2 if has_admin else 1
-
-    summary = f"Thống kê thời gian của {member.display_name}:\n"
+def playtime_report_lines(record, display_name, current_week_start, current_week_end, weeks_to_show):
+    yield f"Thống kê thời gian của {display_name}:\n"
 
     for week_offset in range(weeks_to_show):
         week_start = current_week_start - timedelta(days=7 * week_offset)
@@ -779,13 +2588,13 @@ async def playtime(ctx, member: discord.Member = None):
 
         total_playtime = 0
         playtime_summary = f"\nThời gian chơi GTA5VN.NET từ {week_start_str} đến {week_end_str}:\n"
-        if "daily_playtime" in playtime_data[target_user_id]:
-            for date, minutes in playtime_data[target_user_id]["daily_playtime"].items():
-                if week_start_str <= date <= week_end_str:
-                    total_playtime += minutes
-                    hours = minutes // 60
-                    mins = minutes % 60
-                    playtime_summary += f"- {date}: {int(hours)} giờ {int(mins)} phút\n"
+        for day in range(day_number(week_start), day_number(week_end) + 1):
+            minutes = record.daily_playtime.get(day)
+            if minutes:
+                total_playtime += minutes
+                hours = minutes // 60
+                mins = minutes % 60
+                playtime_summary += f"- {date.fromordinal(day)}: {int(hours)} giờ {int(mins)} phút\n"
 
         if total_playtime == 0:
             playtime_summary += "Chưa có dữ liệu chơi game.\n"
@@ -794,7 +2603,7 @@ async def playtime(ctx, member: discord.Member = None):
             total_mins = total_playtime % 60
             playtime_summary += f"\nTổng thời gian chơi: {int(total_hours)} giờ {int(total_mins)} phút\n"
 
-        summary += playtime_summary
+        yield playtime_summary
 
     for week_offset in range(weeks_to_show):
         week_start = current_week_start - timedelta(days=7 * week_offset)
@@ -804,13 +2613,13 @@ async def playtime(ctx, member: discord.Member = None):
 
         total_online = 0
         online_summary = f"\nThời gian online (on-duty) từ {week_start_str} đến {week_end_str}:\n"
-        if "daily_online" in playtime_data[target_user_id]:
-            for date, minutes in playtime_data[target_user_id]["daily_online"].items():
-                if week_start_str <= date <= week_end_str:
-                    total_online += minutes
-                    hours = minutes // 60
-                    mins = minutes % 60
-                    online_summary += f"- {date}: {int(hours)} giờ {int(mins)} phút\n"
+        for day in range(day_number(week_start), day_number(week_end) + 1):
+            minutes = record.daily_online.get(day)
+            if minutes:
+                total_online += minutes
+                hours = minutes // 60
+                mins = minutes % 60
+                online_summary += f"- {date.fromordinal(day)}: {int(hours)} giờ {int(mins)} phút\n"
 
         if total_online == 0:
             online_summary += "Chưa có dữ liệu online.\n"
@@ -819,9 +2628,90 @@ async def playtime(ctx, member: discord.Member = None):
             total_online_mins = total_online % 60
             online_summary += f"\nTổng thời gian online: {int(total_online_hours)} giờ {int(total_online_mins)} phút\n"
 
-        summary += online_summary
+        yield online_summary
+
+    if record.zone_daily:
+        for week_offset in range(weeks_to_show):
+            week_start = current_week_start - timedelta(days=7 * week_offset)
+            week_end = current_week_end - timedelta(days=7 * week_offset)
+            zone_summary = ""
+            for zone, ring in list(record.zone_daily.items()):
+                total_zone = ring.sum_range(day_number(week_start), day_number(week_end))
+                if total_zone:
+                    zone_summary += f"- {zone}: {int(total_zone // 60)} giờ {int(total_zone % 60)} phút\n"
+            if zone_summary:
+                yield f"\nThời gian trong các khu vực từ {week_start.isoformat()} đến {week_end.isoformat()}:\n" + zone_summary
+
+def month_report_lines(display_name, month_start, online_days, playtime_days):
+    yield f"Thống kê tháng {month_start.month}/{month_start.year} của {display_name}:\n"
+
+    for title, days, empty in (
+        ("Thời gian online (on-duty)", online_days, "Chưa có dữ liệu online.\n"),
+        ("Thời gian chơi GTA5VN.NET", playtime_days, "Chưa có dữ liệu chơi game.\n"),
+    ):
+        yield f"\n{title}:\n"
+        for day in sorted(days):
+            minutes = days[day]
+            yield f"- {date.fromordinal(day)}: {int(minutes // 60)} giờ {int(minutes % 60)} phút\n"
+        total = sum(days.values())
+        if total:
+            yield f"\nTổng: {int(total // 60)} giờ {int(total % 60)} phút\n"
+        else:
+            yield empty
+
+def parse_month(text, year):
+    # "tháng" hoặc "tháng/năm", trả về ngày đầu và ngày cuối tháng
+    parts = [int(part) for part in text.strip().split("/")]
+    if len(parts) == 2:
+        year = parts[1]
+    elif len(parts) != 1:
+        raise ValueError(text)
+    month_start = date(year, parts[0], 1)
+    next_month = date(year + 1, 1, 1) if parts[0] == 12 else date(year, parts[0] + 1, 1)
+    return month_start, next_month - timedelta(days=1)
+
+@bot.command()
+async def playtime(ctx, member: Optional[discord.Member] = None, month: str = None):
+    if not ctx.guild:
+        await ctx.send("Lệnh !playtime chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
+
+    member = member or ctx.author
+    target_user_id = str(member.id)
 
-    await ctx.send(summary)
+    if month:
+        if member.id != ctx.author.id and not has_admin_role(ctx.author):
+            await ctx.send("Bạn chỉ có thể xem lại dữ liệu theo tháng của chính mình. Xem của người khác chỉ dành cho admin.")
+            return
+        try:
+            month_start, month_end = parse_month(month, vn_now().year)
+        except ValueError:
+            await ctx.send("Định dạng không hợp lệ. Vui lòng sử dụng: !playtime [@user] tháng/năm (ví dụ: !playtime @user 1/2025).")
+            return
+        start_day, end_day = day_number(month_start), day_number(month_end)
+        online_days = await user_day_totals(target_user_id, "online", start_day, end_day)
+        playtime_days = await user_day_totals(target_user_id, "playtime", start_day, end_day)
+        if not online_days and not playtime_days:
+            await ctx.send(f"Không có dữ liệu của {member.display_name} trong tháng {month_start.month}/{month_start.year}.")
+            return
+        await send_report(ctx, ReportPages(month_report_lines(member.display_name, month_start, online_days, playtime_days)))
+        return
+
+    if target_user_id not in playtime_data:
+        await ctx.send(f"{member.display_name} chưa chơi GTA5VN.NET hoặc chưa ở trạng thái on-duty trong 2 tuần qua.")
+        return
+
+    record = playtime_data[target_user_id]
+    current_time = vn_now()
+    current_date = current_time.date()
+
+    current_week_start, current_week_end = get_week_boundaries(current_date)
+    previous_week_start = current_week_start - timedelta(days=7)
+    previous_week_end = current_week_end - timedelta(days=7)
+
+    weeks_to_show = 2 if has_admin_role(ctx.author) else 1
+    pages = ReportPages(playtime_report_lines(record, member.display_name, current_week_start, current_week_end, weeks_to_show))
+    await send_report(ctx, pages)
 
 @bot.command()
 async def checktime(ctx, member: discord.Member = None):
@@ -832,146 +2722,135 @@ async def checktime(ctx, member: discord.Member = None):
     member = member or ctx.author
     target_user_id = str(member.id)
 
-    if target_user_id not in playtime_data or "weekly_online" not in playtime_data[target_user_id]:
+    if target_user_id not in playtime_data:
         await ctx.send(f"{member.display_name} chưa có dữ liệu on-duty nào được ghi nhận trong tuần hiện tại.")
         return
 
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
     current_date = current_time.date()
 
     current_week_start, current_week_end = get_week_boundaries(current_date)
-    week_key = current_week_start.isoformat()
 
-    total_online = playtime_data[target_user_id]["weekly_online"].get(week_key, 0)
+    total_online = playtime_data[target_user_id].weekly_online.get(week_number(current_week_start))
 
     hours = int(total_online // 60)
     mins = int(total_online % 60)
 
     await ctx.send(f"Tổng thời gian on-duty của {member.display_name} trong tuần hiện tại (từ {current_week_start} đến {current_week_end}): {hours}h {mins}m.")
 
+def parse_day_month(text, year):
+    # "ngày/tháng" hoặc "ngày/tháng/năm"
+    parts = [int(part) for part in text.strip().split("/")]
+    if len(parts) == 2:
+        return date(year, parts[1], parts[0])
+    if len(parts) == 3:
+        return date(parts[2], parts[1], parts[0])
+    raise ValueError(text)
+
+def parse_date_range(text, year):
+    # "ngày/tháng-ngày/tháng"; nếu không ghi năm mà ngày đầu lớn hơn ngày cuối thì coi như khoảng vắt qua năm mới (vd 28/12-3/1)
+    start_text, end_text = text.split("-")
+    end_date = parse_day_month(end_text, year)
+    start_date = parse_day_month(start_text, end_date.year)
+    if start_date > end_date and start_text.count("/") == 1:
+        start_date = parse_day_month(start_text, end_date.year - 1)
+    return start_date, end_date
+
+CHECKDAYS_USAGE = (
+    "Định dạng không hợp lệ. Vui lòng sử dụng định dạng: !checkdays ngày/tháng hoặc !checkdays ngày/tháng-ngày/tháng "
+    "(có thể thêm năm: ngày/tháng/năm) (ví dụ: !checkdays 25/3, !checkdays 25/3-30/3 hoặc !checkdays 28/12/2024-3/1/2025)."
+)
+
+def online_report_lines(online_totals, header, empty):
+    yield header
+    users_reported = 0
+
+    # Chụp lại roster vì các trang sau có thể được render sau khi roster đã đổi
+    for user_id, display_name in list(roster.members()):
+        total_online = online_totals.get(user_id, 0)
+
+        if total_online > 0:
+            hours = int(total_online // 60)
+            mins = int(total_online % 60)
+            yield f"- {display_name}: {hours}h {mins}m\n"
+            users_reported += 1
+
+    if users_reported == 0:
+        yield empty
+
+async def render_online_report(start_date, end_date):
+    online_totals = await query_online_totals(start_date, end_date)
+
+    if start_date == end_date:
+        header = f"📊 **Thời gian on-duty ngày {start_date.strftime('%d/%m/%Y')}**:\n"
+        empty = f"Không có ai on-duty trong ngày {start_date.strftime('%d/%m/%Y')}.\n"
+    else:
+        header = f"📊 **Thời gian on-duty từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}**:\n"
+        empty = f"Không có ai on-duty trong khoảng thời gian từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}.\n"
+
+    return ReportPages(online_report_lines(online_totals, header, empty))
+
 @bot.command(name="checkdays")
 async def checkdays(ctx, *, date_range: str):
     if not ctx.guild:
         await ctx.send("Lệnh !checkdays chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
         return
 
-    current_time = datetime.now(VN_TIMEZONE)
-    current_year = current_time.year
+    current_date = vn_now().date()
 
     if "-" in date_range:
         try:
-            start_date_str, end_date_str = date_range.split("-")
-            start_day, start_month = map(int, start_date_str.split("/"))
-            end_day, end_month = map(int, end_date_str.split("/"))
-
-            start_date = date(current_year, start_month, start_day)
-            end_date = date(current_year, end_month, end_day)
+            start_date, end_date = parse_date_range(date_range, current_date.year)
 
             if start_date > end_date:
                 await ctx.send("Ngày bắt đầu phải nhỏ hơn hoặc bằng ngày kết thúc. Vui lòng thử lại.")
                 return
 
         except ValueError:
-            await ctx.send("Định dạng không hợp lệ. Vui lòng sử dụng định dạng: !checkdays ngày/tháng hoặc !checkdays ngày/tháng-ngày/tháng (ví dụ: !checkdays 25/3 hoặc !checkdays 25/3-30/3).")
+            await ctx.send(CHECKDAYS_USAGE)
             return
 
-        start_date_str = start_date.isoformat()
-        end_date_str = end_date.isoformat()
-
-        report = f"📊 **Thời gian on-duty từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}**:\n"
-        users_reported = 0
-
-        users_to_remove = []
-
-        for user_id, user_info in user_mapping.items():
-            if not isinstance(user_info, dict):
-                users_to_remove.append(user_id)
-                continue
-
-            guild_id = user_info.get("guild_id")
-            if not guild_id:
-                users_to_remove.append(user_id)
-                continue
-
-            guild = bot.get_guild(int(guild_id))
-            if not guild:
-                users_to_remove.append(user_id)
-                continue
-
-            member = guild.get_member(int(user_id))
-            if not member:
-                continue
-
-            total_online = 0
-            if user_id in playtime_data and "daily_online" in playtime_data[user_id]:
-                for date_str, minutes in playtime_data[user_id]["daily_online"].items():
-                    date_obj = datetime.fromisoformat(date_str).date()
-                    if start_date <= date_obj <= end_date:
-                        total_online += minutes
-
-            if total_online > 0:
-                hours = int(total_online // 60)
-                mins = int(total_online % 60)
-                report += f"- {member.display_name}: {hours}h {mins}m\n"
-                users_reported += 1
-
-        if users_reported == 0:
-            report += f"Không có ai on-duty trong khoảng thời gian từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}.\n"
-
     else:
         try:
-            day, month = map(int, date_range.split("/"))
-            target_date = date(current_year, month, day)
+            target_date = parse_day_month(date_range, current_date.year)
         except ValueError:
-            await ctx.send("Định dạng không hợp lệ. Vui lòng sử dụng định dạng: !checkdays ngày/tháng hoặc !checkdays ngày/tháng-ngày/tháng (ví dụ: !checkdays 25/3 hoặc !checkdays 25/3-30/3).")
+            await ctx.send(CHECKDAYS_USAGE)
             return
 
-        target_date_str = target_date.isoformat()
-
-        report = f"📊 **Thời gian on-duty ngày {target_date.strftime('%d/%m/%Y')}**:\n"
-        users_reported = 0
-
-        users_to_remove = []
-
-        for user_id, user_info in user_mapping.items():
-            if not isinstance(user_info, dict):
-                users_to_remove.append(user_id)
-                continue
-
-            guild_id = user_info.get("guild_id")
-            if not guild_id:
-                users_to_remove.append(user_id)
-                continue
+        start_date = end_date = target_date
 
-            guild = bot.get_guild(int(guild_id))
-            if not guild:
-                users_to_remove.append(user_id)
-                continue
-
-            member = guild.get_member(int(user_id))
-            if not member:
-                continue
+    pages = await cached_report(
+        ("checkdays", ctx.guild.id, start_date, end_date), lambda: render_online_report(start_date, end_date)
+    )
+    await send_report(ctx, pages)
 
-            total_online = 0
-            if user_id in playtime_data and "daily_online" in playtime_data[user_id]:
-                total_online = playtime_data[user_id]["daily_online"].get(target_date_str, 0)
+def ranked_week_lines(week, limit=None, suffix=""):
+    # Đọc thẳng từ leaderboard, chỉ lấy người còn trong roster
+    rank = 0
+    for user_id, total_online in leaderboard.ranked(week):
+        if limit is not None and rank >= limit:
+            return
+        display_name = roster.display_name(user_id)
+        if display_name is None or total_online <= 0:
+            continue
+        rank += 1
+        hours = int(total_online // 60)
+        mins = int(total_online % 60)
+        yield f"{rank}. {display_name}: {hours}h {mins}m{suffix}\n"
 
-            if total_online > 0:
-                hours = int(total_online // 60)
-                mins = int(total_online % 60)
-                report += f"- {member.display_name}: {hours}h {mins}m\n"
-                users_reported += 1
+def week_report_lines(header, week, empty, limit=None, suffix=""):
+    yield header
+    users_reported = 0
 
-        if users_reported == 0:
-            report += f"Không có ai on-duty trong ngày {target_date.strftime('%d/%m/%Y')}.\n"
+    for line in ranked_week_lines(week, limit, suffix):
+        yield line
+        users_reported += 1
 
-    await ctx.send(report)
+    if users_reported == 0:
+        yield empty
 
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+async def render_week_report(header, week, empty, limit=None, suffix=""):
+    return ReportPages(week_report_lines(header, week, empty, limit, suffix))
 
 @bot.command(name="lichsu")
 async def lichsu_onduty(ctx):
@@ -983,58 +2862,20 @@ async def lichsu_onduty(ctx):
         await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
         return
 
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
     current_date = current_time.date()
 
     current_week_start, _ = get_week_boundaries(current_date)
     last_week_start = current_week_start - timedelta(days=7)
     last_week_end = last_week_start + timedelta(days=6)
-    last_week_key = last_week_start.isoformat()
-
-    report = f"📊 **Lịch sử on-duty tuần trước (từ {last_week_start} đến {last_week_end})**:\n"
-    users_reported = 0
-
-    users_to_remove = []
 
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
-
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
-
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
-
-        total_online = 0
-        if user_id in playtime_data and "weekly_online" in playtime_data[user_id]:
-            total_online = playtime_data[user_id]["weekly_online"].get(last_week_key, 0)
-
-        if total_online > 0:
-            hours = int(total_online // 60)
-            mins = int(total_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m/1 tuần\n"
-            users_reported += 1
-
-    if users_reported == 0:
-        report += "Không có ai on-duty trong tuần trước.\n"
-
-    await ctx.send(report)
-
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+    pages = await cached_report(("lichsu", ctx.guild.id, week_number(last_week_start)), lambda: render_week_report(
+        f"📊 **Lịch sử on-duty tuần trước (từ {last_week_start} đến {last_week_end})**:\n",
+        week_number(last_week_start),
+        "Không có ai on-duty trong tuần trước.\n",
+        suffix="/1 tuần",
+    ))
+    await send_report(ctx, pages)
 
 @bot.command(name="checkreg")
 async def checkreg(ctx):
@@ -1046,56 +2887,79 @@ async def checkreg(ctx):
         await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
         return
 
-    current_time = datetime.now(VN_TIMEZONE)
+    current_time = vn_now()
     current_date = current_time.date()
 
     current_week_start, current_week_end = get_week_boundaries(current_date)
-    week_key = current_week_start.isoformat()
 
-    report = f"📊 **Lịch sử on-duty tuần hiện tại (từ {current_week_start} đến {current_week_end})**:\n"
-    users_reported = 0
+    pages = await cached_report(("checkreg", ctx.guild.id, week_number(current_week_start)), lambda: render_week_report(
+        f"📊 **Lịch sử on-duty tuần hiện tại (từ {current_week_start} đến {current_week_end})**:\n",
+        week_number(current_week_start),
+        "Không có ai on-duty trong tuần hiện tại.\n",
+    ))
+    await send_report(ctx, pages)
 
-    users_to_remove = []
+@bot.command(name="top")
+async def top(ctx, n: int = 10, week: str = None):
+    if not ctx.guild:
+        await ctx.send("Lệnh !top chỉ có thể được sử dụng trong server, không hỗ trợ trong DM.")
+        return
 
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
+    if not has_admin_role(ctx.author):
+        await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
+        return
 
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
+    current_date = vn_now().date()
+    try:
+        target_date = parse_day_month(week, current_date.year) if week else current_date
+    except ValueError:
+        await ctx.send("Định dạng không hợp lệ. Vui lòng sử dụng: !top [số người] [ngày/tháng] (ví dụ: !top 10 25/3).")
+        return
 
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
+    week_start, week_end = get_week_boundaries(target_date)
 
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
+    pages = await cached_report(("top", ctx.guild.id, n, week_number(week_start)), lambda: render_week_report(
+        f"🏆 **Top {n} on-duty tuần từ {week_start} đến {week_end}**:\n",
+        week_number(week_start),
+        "Không có ai on-duty trong tuần này.\n",
+        limit=n,
+    ))
+    await send_report(ctx, pages)
 
-        total_online = 0
-        if user_id in playtime_data and "weekly_online" in playtime_data[user_id]:
-            total_online = playtime_data[user_id]["weekly_online"].get(week_key, 0)
+async def render_onduty_entries():
+    entries = []
+    for user_id, display_name in roster.members():
+        if user_id in online_start_times:
+            start_time = online_start_times[user_id]
+            entries.append((f"- {display_name}: ", start_time, f" (bắt đầu từ {start_time.strftime('%H:%M:%S %Y-%m-%d')})\n"))
+    return entries
 
-        if total_online > 0:
-            hours = int(total_online // 60)
-            mins = int(total_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m\n"
+def offduty_report_lines():
+    yield "📊 **Danh sách người chơi đang off-duty**:\n"
+    users_reported = 0
+
+    for user_id, display_name in list(roster.members()):
+        if user_id not in online_start_times:
+            yield f"- {display_name}\n"
             users_reported += 1
 
     if users_reported == 0:
-        report += "Không có ai on-duty trong tuần hiện tại.\n"
+        yield "Không có ai đang off-duty.\n"
+
+async def render_offduty_report():
+    return ReportPages(offduty_report_lines())
 
-    await ctx.send(report)
+def onduty_report_lines(entries, current_time):
+    yield "📊 **Danh sách người chơi đang on-duty**:\n"
 
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+    for prefix, start_time, suffix in entries:
+        time_online = (current_time - start_time).total_seconds() / 60
+        hours = int(time_online // 60)
+        mins = int(time_online % 60)
+        yield f"{prefix}{hours}h {mins}m{suffix}"
+
+    if not entries:
+        yield "Không có ai đang on-duty.\n"
 
 @bot.command(name="checkduty")
 async def checkduty(ctx):
@@ -1107,49 +2971,9 @@ async def checkduty(ctx):
         await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
         return
 
-    current_time = datetime.now(VN_TIMEZONE)
-    report = "📊 **Danh sách người chơi đang on-duty**:\n"
-    users_reported = 0
-
-    users_to_remove = []
-
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
-
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
-
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
-
-        if user_id in online_start_times:
-            start_time = online_start_times[user_id]
-            time_online = (current_time - start_time).total_seconds() / 60
-            hours = int(time_online // 60)
-            mins = int(time_online % 60)
-            report += f"- {member.display_name}: {hours}h {mins}m (bắt đầu từ {start_time.strftime('%H:%M:%S %Y-%m-%d')})\n"
-            users_reported += 1
-
-    if users_reported == 0:
-        report += "Không có ai đang on-duty.\n"
-
-    await ctx.send(report)
-
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+    # Phần cố định (tên, giờ bắt đầu) lấy từ cache, chỉ thời gian đã on-duty được tính lại mỗi lần gọi
+    entries = await cached_report(("checkduty", ctx.guild.id), render_onduty_entries)
+    await send_report(ctx, ReportPages(onduty_report_lines(entries, vn_now())))
 
 @bot.command(name="checkoff")
 async def checkoff(ctx):
@@ -1161,43 +2985,12 @@ async def checkoff(ctx):
         await ctx.send("Bạn không có quyền sử dụng lệnh này. Lệnh này chỉ dành cho admin.")
         return
 
-    report = "📊 **Danh sách người chơi đang off-duty**:\n"
-    users_reported = 0
-
-    users_to_remove = []
-
-    for user_id, user_info in user_mapping.items():
-        if not isinstance(user_info, dict):
-            users_to_remove.append(user_id)
-            continue
-
-        guild_id = user_info.get("guild_id")
-        if not guild_id:
-            users_to_remove.append(user_id)
-            continue
-
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            users_to_remove.append(user_id)
-            continue
-
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
-
-        if user_id not in online_start_times:
-            report += f"- {member.display_name}\n"
-            users_reported += 1
-
-    if users_reported == 0:
-        report += "Không có ai đang off-duty.\n"
-
-    await ctx.send(report)
-
-    for user_id in users_to_remove:
-        if user_id in user_mapping:
-            del user_mapping[user_id]
-    if users_to_remove:
-        save_user_mapping(user_mapping)
+    pages = await cached_report(("checkoff", ctx.guild.id), render_offduty_report)
+    await send_report(ctx, pages)
 
-bot.run("MTE0MDk5NTc0MjExOTUxMDExNw.GgxtR5.qeWGlPE6m5r3VLAlwcs5uecCWZmakRDDGH4wms")
\ No newline at end of file
+if __name__ == "__main__":
+    # Được import (vd bởi bench.py) thì không kết nối Discord
+    try:
+        bot.run("MTE0MDk5NTc0MjExOTUxMDExNw.GgxtR5.qeWGlPE6m5r3VLAlwcs5uecCWZmakRDDGH4wms")
+    finally:
+        flush_storage_sync()
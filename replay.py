@@ -0,0 +1,207 @@
+# Phát lại log sự kiện do EventRecorder (EVENT_LOG_FILE trong bots.py) ghi, qua đúng các handler của bots.py,
+# với client giả và đồng hồ ảo nên kết quả không phụ thuộc tốc độ phát. In tổng thời gian theo người dạng JSON
+# và có thể so với lần chạy trước, ví dụ:
+#     python replay.py events.log.2 events.log.1 events.log --speed 60 --output run1.json
+#     python replay.py events.log.2 events.log.1 events.log --speed 0 --compare run1.json
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import discord
+
+from bench import BOT_DIR, FakeChannel, FakeContext, FakeGuild, FakeMember
+
+def load_events(paths):
+    events = []
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # Dòng cuối bị ghi dở do bot tắt đột ngột
+                    continue
+    events.sort(key=lambda event: event["t"])
+    return events
+
+class ReplayClient:
+    def __init__(self, bots):
+        self.bots = bots
+        self.guilds = {}
+        self.channels = {}
+        bots.bot.get_guild = self.guilds.get
+        bots.bot.get_channel = lambda channel_id: self.channels.setdefault(channel_id, FakeChannel(channel_id))
+
+    def guild(self, guild_id):
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = FakeGuild(guild_id)
+        return self.guilds[guild_id]
+
+    def member(self, event, status=None, activities=None):
+        # Như discord.py: member trong cache bị sửa tại chỗ, before là bản chụp trạng thái cũ
+        guild = self.guild(event["g"])
+        member = guild.members.get(event["u"])
+        if member is None:
+            member = guild.members[event["u"]] = FakeMember(event["u"], guild, discord.Status.online, [])
+        previous = member.copy()
+        if status is not None:
+            member.status = status
+        if activities is not None:
+            member.activities = activities
+        member.name = event["n"]
+        member.display_name = event["d"]
+        member.roles = [SimpleNamespace(id=int(role_id)) for role_id in event.get("r", [])]
+        return previous, member
+
+    def argument(self, value, guild):
+        if isinstance(value, dict) and "m" in value:
+            return guild.members.get(value["m"]) or FakeMember(value["m"], guild, discord.Status.offline, [])
+        return value
+
+    def activity(self, kind, name, state, details, cls="Activity"):
+        # Log cũ không có tên lớp thì coi như discord.Activity. CustomActivity/Spotify/Streaming... bị
+        # ActivityClassifier bỏ qua nên không cần dựng lại
+        if cls == "Game":
+            return discord.Game(name=name)
+        if cls == "Activity":
+            return discord.Activity(type=discord.ActivityType(kind), name=name, state=state, details=details)
+        return None
+
+    async def presence(self, event):
+        activities = [activity for activity in (self.activity(*fields) for fields in event["a"]) if activity is not None]
+        previous, member = self.member(event, discord.Status(event["s"]), activities)
+        await self.bots.on_presence_update(previous, member)
+
+    async def command(self, event):
+        command = self.bots.bot.get_command(event["c"])
+        if command is None:
+            print(f"Bỏ qua lệnh không tồn tại: {event['c']}", file=sys.stderr)
+            return
+        # Đợi các presence trước đó xử lý xong để thứ tự lệnh/presence giống lúc ghi
+        await self.drain()
+        _, author = self.member(event)
+        guild = author.guild
+        args = [self.argument(value, guild) for value in event.get("x", [])]
+        kwargs = {key: self.argument(value, guild) for key, value in event.get("k", {}).items()}
+        try:
+            await command.callback(FakeContext(author), *args, **kwargs)
+        except Exception as e:
+            print(f"Lệnh {event['c']} lỗi khi phát lại: {e!r}", file=sys.stderr)
+
+    async def drain(self):
+        for queue in self.bots.presence_workers.queues:
+            await queue.join()
+
+def totals(bots):
+    result = {}
+    for user_id, record in bots.playtime_data.items():
+        zones = {zone: sum(minutes for _, minutes in ring.items()) for zone, ring in (record.zone_daily or {}).items()}
+        result[user_id] = {
+            "online": sum(minutes for _, minutes in record.daily_online.items()),
+            "playtime": sum(minutes for _, minutes in record.daily_playtime.items()),
+            "zones": zones,
+        }
+    return result
+
+def compare(current, baseline, tolerance):
+    differences = []
+    for user_id in sorted(set(current) | set(baseline)):
+        now = current.get(user_id, {})
+        before = baseline.get(user_id, {})
+        for field in ("online", "playtime"):
+            delta = now.get(field, 0) - before.get(field, 0)
+            if abs(delta) > tolerance:
+                differences.append({"user_id": user_id, "field": field, "baseline": before.get(field, 0), "current": now.get(field, 0), "delta": delta})
+        for zone in sorted(set(now.get("zones", {})) | set(before.get("zones", {}))):
+            delta = now.get("zones", {}).get(zone, 0) - before.get("zones", {}).get(zone, 0)
+            if abs(delta) > tolerance:
+                differences.append({"user_id": user_id, "field": f"zone:{zone}", "delta": delta})
+    return differences
+
+async def replay(args, bots, events):
+    client = ReplayClient(bots)
+    clock = {"now": bots.vn_now()}
+    bots.vn_now = lambda: clock["now"]
+    handled = 0
+    started = time.perf_counter()
+    first = events[0]["t"] if events else 0
+
+    for event in events:
+        if args.speed:
+            delay = started + (event["t"] - first) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        clock["now"] = datetime.fromtimestamp(event["t"], bots.VN_TIMEZONE)
+        if event["e"] == "p":
+            await client.presence(event)
+        elif event["e"] == "c":
+            await client.command(event)
+        handled += 1
+        if handled % 256 == 0:
+            await asyncio.sleep(0)
+
+    await client.drain()
+    await bots.flush_storage()
+    await asyncio.get_running_loop().run_in_executor(bots.persist_executor, lambda: None)
+    return {
+        "events": handled,
+        "seconds": time.perf_counter() - started,
+        "recorded_seconds": events[-1]["t"] - first if events else 0,
+        "open_sessions": {kind: len(sessions) for kind, sessions in bots.session_maps.items()},
+        "totals": totals(bots),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Phát lại log sự kiện của bots.py với client giả")
+    parser.add_argument("logs", nargs="+", help="các file log (kể cả file đã xoay vòng), thứ tự không quan trọng")
+    parser.add_argument("--speed", type=float, default=0, help="phát nhanh gấp N lần thời gian thật, 0 = nhanh nhất có thể")
+    parser.add_argument("--data-dir", help="thư mục chứa playtime.json/user_mapping.json... dùng làm trạng thái ban đầu")
+    parser.add_argument("--output", help="ghi kết quả JSON vào file thay vì stdout")
+    parser.add_argument("--compare", help="file JSON kết quả của lần chạy trước để so tổng thời gian")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="chênh lệch (phút) được bỏ qua khi so sánh")
+    args = parser.parse_args()
+
+    events = load_events(args.logs)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    # bots.py đọc/ghi dữ liệu ở thư mục hiện tại nên phát lại trong thư mục tạm
+    sys.path.insert(0, BOT_DIR)
+    workdir = tempfile.mkdtemp(prefix="botofa-replay-")
+    if args.data_dir:
+        for name in os.listdir(args.data_dir):
+            source = os.path.join(args.data_dir, name)
+            if os.path.isfile(source):
+                shutil.copy(source, workdir)
+    os.chdir(workdir)
+    import bots
+    # Không ghi lại chính các sự kiện đang phát
+    bots.event_recorder = None
+
+    result = asyncio.run(replay(args, bots, events))
+    bots.flush_storage_sync()
+
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+        result["differences"] = compare(result["totals"], baseline.get("totals", baseline), args.tolerance)
+        exit_code = 1 if result["differences"] else 0
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
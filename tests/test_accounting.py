@@ -0,0 +1,115 @@
+# So sánh split_interval/account_intervals với vòng lặp chia theo ngày cũ (offduty/doffduty/on_presence_update
+# trước khi gộp), trên các khoảng thời gian ngẫu nhiên có seed cố định.
+# Vòng lặp cũ đã được sửa hai lỗi đã biết: mỗi ranh giới ngày bị mất 1 giây, và datetime.combine(..., tzinfo=VN_TIMEZONE)
+# dùng offset LMT +07:06:40 của pytz thay vì +07:00
+import importlib
+import os
+import random
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRIALS = 2000
+
+@pytest.fixture(scope="module")
+def bots(tmp_path_factory):
+    # bots.py đọc/ghi dữ liệu ở thư mục hiện tại nên import trong thư mục tạm
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bots"))
+    sys.path.insert(0, BOT_DIR)
+    try:
+        yield importlib.import_module("bots")
+    finally:
+        sys.path.remove(BOT_DIR)
+        os.chdir(cwd)
+
+def legacy_split(bots, start, end):
+    midnight = lambda d: bots.VN_TIMEZONE.localize(datetime.combine(d, datetime.min.time()))
+    parts = {}
+    current_date = start
+    while current_date.date() <= end.date():
+        if current_date.date() == end.date():
+            end_of_period = end
+        else:
+            end_of_period = midnight(current_date.date() + timedelta(days=1))
+
+        if current_date.date() == start.date():
+            start_of_period = start
+        else:
+            start_of_period = midnight(current_date.date())
+
+        minutes = (end_of_period - start_of_period).total_seconds() / 60
+        if minutes:
+            parts[bots.day_number(current_date.date())] = minutes
+        current_date = current_date + timedelta(days=1)
+    return parts
+
+def random_interval(bots, rng, span_days=2 * 365):
+    # Mốc bắt đầu trong span_days ngày kể từ 2026-01-01, độ dài từ 0 tới 5 ngày; một phần bắt đầu/kết thúc đúng nửa đêm
+    start = 1767225600 + rng.randrange(span_days * 86400)
+    if rng.random() < 0.1:
+        start -= (start + 7 * 3600) % 86400
+    length = rng.choice([0, rng.randrange(60), rng.randrange(86400), rng.randrange(5 * 86400)])
+    end = start + length
+    if rng.random() < 0.1:
+        end -= (end + 7 * 3600) % 86400
+        end = max(end, start)
+    return datetime.fromtimestamp(start, bots.VN_TIMEZONE), datetime.fromtimestamp(end, bots.VN_TIMEZONE)
+
+def test_split_interval_matches_legacy_loop(bots):
+    rng = random.Random(6)
+    for _ in range(TRIALS):
+        start, end = random_interval(bots, rng)
+        parts = dict(bots.split_interval(start, end))
+        expected = legacy_split(bots, start, end)
+        assert parts.keys() == expected.keys(), (start, end)
+        for day, minutes in expected.items():
+            assert parts[day] == pytest.approx(minutes, abs=1e-6), (start, end, day)
+
+def test_split_interval_accepts_other_timezones(bots):
+    rng = random.Random(7)
+    for _ in range(200):
+        start, end = random_interval(bots, rng)
+        utc = bots.pytz.utc
+        assert bots.split_interval(start.astimezone(utc), end.astimezone(utc)) == bots.split_interval(start, end)
+
+def test_account_intervals_batch_matches_legacy_per_day_and_week(bots):
+    rng = random.Random(8)
+    for trial in range(200):
+        intervals = []
+        for user in range(3):
+            start, end = random_interval(bots, rng)
+            # Vài khoảng liên tiếp của cùng một người, giống lúc bù nhiều phiên một lần
+            for _ in range(rng.randrange(1, 4)):
+                step = timedelta(seconds=rng.randrange(6 * 3600))
+                intervals.append((str(1000 + trial * 3 + user), start, start + step))
+                start += step + timedelta(seconds=rng.randrange(3600))
+
+        daily = defaultdict(float)
+        weekly = defaultdict(float)
+        for user_id, start, end in intervals:
+            for day, minutes in legacy_split(bots, start, end).items():
+                daily[user_id, day] += minutes
+                weekly[user_id, bots.week_number(datetime.fromordinal(day).date())] += minutes
+
+        bots.account_intervals(intervals, "online", max(end for _, _, end in intervals))
+        for (user_id, day), minutes in daily.items():
+            assert bots.playtime_data[user_id].daily_online.get(day) == pytest.approx(minutes, abs=1e-6)
+        for (user_id, week), minutes in weekly.items():
+            assert bots.playtime_data[user_id].weekly_online.get(week) == pytest.approx(minutes, abs=1e-6)
+
+def test_account_intervals_batch_matches_one_by_one(bots):
+    rng = random.Random(9)
+    # Gói trong ít ngày hơn cửa sổ lưu giữ để không có ô nào bị lưu trữ giữa chừng
+    intervals = [random_interval(bots, rng, span_days=7) for _ in range(300)]
+    bots.account_intervals([("1", start, end) for start, end in intervals], "playtime", intervals[-1][1])
+    for start, end in intervals:
+        bots.account_intervals([("2", start, end)], "playtime", end)
+    batched = dict(bots.playtime_data["1"].daily_playtime.items())
+    single = dict(bots.playtime_data["2"].daily_playtime.items())
+    assert batched.keys() == single.keys()
+    for day, minutes in single.items():
+        assert batched[day] == pytest.approx(minutes, abs=1e-6)